@@ -1,18 +1,317 @@
+from __future__ import annotations
+
+import argparse
+import ast
+import contextlib
+import functools
 import glob
+import hashlib
+import heapq
+import io
 import json
 import math
+import multiprocessing
 import os
+import queue
 import random
 import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ProcessPoolExecutor, as_completed, wait
+from typing import TYPE_CHECKING
+
+# The heavy dependencies are imported by the functions that use them, so that stages which don't need them
+# (eg just recounting txt files) start up quickly
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image as PILImage
+
+# CHANGE THIS LINE to be the absolute path to the tesseract unix executable file
+TESSERACT_CMD = '/anaconda3/envs/MemosToNotes3/bin/tesseract'
+
+# Resolution, in dpi, that pdfs are rasterized at before OCR
+RESOLUTION = 200
+
+# Extra command line options passed to tesseract, eg "--psm 6"
+TESSERACT_CONFIG = ""
+
+# Where OCR'd pages are cached, shared between all the course roots. See pdfs_to_texts()
+OCR_CACHE_DIR = "ocr_cache"
+
+# Pages with fewer words than this in their text layer are assumed to be scanned, and are OCR'd instead
+MIN_TEXT_LAYER_WORDS = 5
+
+# Roughly how many penalty values write_penalties() holds in memory at once
+PENALTY_BLOCK_SIZE = 1 << 24
+
+# Default resolution, in dpi, of the saved charts
+CHART_DPI = 400
+
+# The first bytes of every file made by write_vocabulary_sidecar()
+VOCABULARY_MAGIC = b"MTNVOCAB"
+
+# Words shorter than this are too ambiguous to fuzzy match, see build_fuzzy_index()
+FUZZY_MIN_LENGTH = 5
+
+# The syllables that create_word_list() makes words of, taken from the words of a programming course
+WORD_SYLLABLES = ["al", "go", "rithm", "re", "cur", "sion", "sive", "ar", "ray", "list", "stack", "que", "ue", "tree",
+                  "node", "hash", "ta", "ble", "sort", "ing", "ed", "er", "func", "tion", "var", "i", "a", "pro",
+                  "gram", "com", "pile", "con", "di", "ver", "loop", "in", "dex", "val", "ob", "ject", "class",
+                  "meth", "od", "point", "mem", "o", "ry", "bi", "na", "struc", "ture", "pa", "ram", "e", "ter",
+                  "log", "ic", "op", "ment", "ex", "cep", "state", "mod", "ule", "im", "port", "de", "fine"]
+
+# Whitespace and meaningless punctuation, which separate words. See normalise_text()
+SEPARATORS = re.compile(r"[\s.,;:\"@|]+")
+
+# How many characters tokenize_file() reads at a time
+TOKENIZE_CHUNK_SIZE = 1 << 16
+
+# The ways count_ngrams() can count tokens. "substring" matches the output of the original fancy_count()
+COUNT_MODES = ("substring", "token")
+
+# The environment variable that tells stage() where to write the report. It's an environment variable rather than a
+# global so that worker processes pick it up too, however they are started. See start_report()
+REPORT_ENVIRONMENT_VARIABLE = "MEMOS_TO_NOTES_REPORT"
+
+# Where benchmark_pipeline() keeps its results. It isn't tracked by git, so it survives checking out other commits
+BENCHMARK_RESULTS_PATH = "benchmarks.jsonl"
+
+# The patterns that start each question and subquestion of a paper, used if a course has no regex.txt yet. The label
+# of a question is the first group of its pattern, or the first word of the match if there isn't a group.
+# See split_into_questions()
+QUESTION_PATTERNS = {
+    "regex_question": r"(Question [0-9]+\s)",
+    "regex_subquestion": r"\([a-z]+\)\s+[A-Z]",
+}
+
+# The label of the text before the first question of a paper, eg the instructions on the cover page
+PREAMBLE_LABEL = "preamble"
+
+# The inverted index of the questions of a root, kept in root/summaries. See index_questions()
+QUESTION_INDEX_NAME = "question_index.sqlite"
+
+# How much of the question index sqlite can keep in memory, in KiB
+QUESTION_INDEX_CACHE_KIB = 1 << 16
+
+
+def import_pyplot():
+    """
+    Import matplotlib's pyplot, using the non-interactive backend since charts are only ever saved to files
+    :return: the pyplot module
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    return plt
+
+
+def peak_rss() -> int | None:
+    """
+    :return: the peak resident memory of this process so far, in bytes, or None where that isn't available (Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def current_rss() -> int | None:
+    """
+    :return: the resident memory of this process right now, in bytes, or None where that isn't available (anywhere
+    but Linux)
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def memory_fields(start: tuple) -> dict:
+    """
+    The memory use of a stage, for its report record. The peak of the process is only ever the highest it has been
+    since the process started, so a stage's own share of it is how much the peak grew while the stage ran
+    :param start: (current_rss(), peak_rss()) from when the stage started
+    :return: dict with the "rss_start_bytes" and "rss_end_bytes" of the stage, the "peak_growth_bytes" of the
+    process while it ran, and the "process_peak_rss_bytes" when it ended. Any of them can be None, see peak_rss()
+    """
+    rss_start, peak_start = start
+    peak_end = peak_rss()
+    return {"rss_start_bytes": rss_start, "rss_end_bytes": current_rss(), "process_peak_rss_bytes": peak_end,
+            "peak_growth_bytes": None if peak_end is None else peak_end - peak_start}
+
+
+def write_report_record(record: dict) -> None:
+    """
+    Append record as one line of the report started by start_report(), if there is one.
+    Each line is written in a single call, so worker processes can share the file
+    :param record:
+    :rtype: None
+    """
+    report_path = os.environ.get(REPORT_ENVIRONMENT_VARIABLE)
+    if report_path is None:
+        return
+    with open(report_path, "a") as report_file:
+        report_file.write(json.dumps(record) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name: str, document: str = None, **fields):
+    """
+    Time the code in the with block and add it to the report as one line of JSON, with the wall time, CPU time and
+    memory use of the block (see memory_fields()), along with the document (pdf, page, txt or json file) it was
+    working on.
+    Does nothing but run the block when there is no report, see start_report()
+    :param name: the stage of the pipeline: "rasterize", "text_layer", "ocr", "tokenize", "count", "aggregate",
+    "penalties", "score" or "render"
+    :param document: what the stage is working on
+    :param fields: anything else to record
+    :return: yields the record as a dict, so the block can add to it, eg record["items"] = number of pages
+    """
+    record = dict(fields, stage=name, document=document)
+    if os.environ.get(REPORT_ENVIRONMENT_VARIABLE) is None:
+        yield record
+        return
+    started, wall, cpu, memory = time.time(), time.perf_counter(), time.process_time(), (current_rss(), peak_rss())
+    try:
+        yield record
+    except BaseException as error:
+        record["error"] = repr(error)
+        raise
+    finally:
+        record.update(started=started, wall_seconds=time.perf_counter() - wall,
+                      cpu_seconds=time.process_time() - cpu, pid=os.getpid(), **memory_fields(memory))
+        write_report_record(record)
+
+
+def timed_iter(iterable, name: str, document: str = None, **fields):
+    """
+    Like stage(), but for a generator that is consumed bit by bit. Only the time spent getting each item out of
+    iterable is counted, not the time the caller spends using it. Memory is measured from the first item to the
+    last, so it includes what the caller does with the items. One line is added to the report once iterable is
+    exhausted, or the caller stops early and this generator is closed, with the number of items in record["items"]
+    :param iterable:
+    :param name: see stage()
+    :param document:
+    :param fields:
+    :return: yields every item of iterable
+    """
+    if os.environ.get(REPORT_ENVIRONMENT_VARIABLE) is None:
+        yield from iterable
+        return
+    record = dict(fields, stage=name, document=document, started=time.time(), wall_seconds=0.0, cpu_seconds=0.0,
+                  items=0)
+    memory = (current_rss(), peak_rss())
+    iterator = iter(iterable)
+    try:
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                record["wall_seconds"] += time.perf_counter() - wall
+                record["cpu_seconds"] += time.process_time() - cpu
+            record["items"] += 1
+            yield item
+    except GeneratorExit:
+        # The caller didn't need the rest, eg ocr_page() only takes one page
+        raise
+    except BaseException as error:
+        record["error"] = repr(error)
+        raise
+    finally:
+        record.update(pid=os.getpid(), **memory_fields(memory))
+        write_report_record(record)
+
+
+def start_report(report_path: str) -> None:
+    """
+    Start recording every stage() of the pipeline to report_path, replacing anything already there.
+    The report has one JSON object per line, see summarise_report()
+    :param report_path:
+    :rtype: None
+    """
+    with open(report_path, "w"):
+        pass
+    os.environ[REPORT_ENVIRONMENT_VARIABLE] = os.path.abspath(report_path)
 
-import numpy as np
-import pytesseract
-import seaborn as sns
-from PIL import Image as PILImage
-from matplotlib import pyplot as plt
-from nltk import corpus
-from wand.color import Color
-from wand.image import Image as WandImage
+
+def stop_report() -> None:
+    """
+    Stop recording stages, see start_report()
+    :rtype: None
+    """
+    os.environ.pop(REPORT_ENVIRONMENT_VARIABLE, None)
+
+
+def summarise_report(report_path: str) -> dict:
+    """
+    Add up the report made by start_report() for each stage
+    :param report_path:
+    :return: dict of stage : {"records", "wall_seconds", "cpu_seconds", "peak_growth_bytes", "max_rss_bytes",
+    "process_peak_rss_bytes", "slowest"} where
+    peak_growth_bytes is how much the stage raised the peak memory of the processes it ran in, added up,
+    max_rss_bytes is the most memory any one record of the stage ended with,
+    process_peak_rss_bytes is the highest peak of a process that ran the stage, including what earlier stages used,
+    and slowest is the document that took the longest in that stage.
+    The memory fields are None where they aren't available, see memory_fields()
+    """
+    summary = {}
+    with open(report_path, "r") as report_file:
+        for line in report_file:
+            record = json.loads(line)
+            totals = summary.setdefault(record["stage"], {"records": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                          "peak_growth_bytes": None, "max_rss_bytes": None,
+                                                          "process_peak_rss_bytes": None, "slowest": (None, 0.0)})
+            totals["records"] += 1
+            totals["wall_seconds"] += record["wall_seconds"]
+            totals["cpu_seconds"] += record["cpu_seconds"]
+            if record["peak_growth_bytes"] is not None:
+                totals["peak_growth_bytes"] = (totals["peak_growth_bytes"] or 0) + record["peak_growth_bytes"]
+            for field, record_field in (("max_rss_bytes", "rss_end_bytes"),
+                                        ("process_peak_rss_bytes", "process_peak_rss_bytes")):
+                if record[record_field] is not None:
+                    totals[field] = max(totals[field] or 0, record[record_field])
+            if record["wall_seconds"] >= totals["slowest"][1]:
+                totals["slowest"] = (record["document"], record["wall_seconds"])
+    return summary
+
+
+@contextlib.contextmanager
+def profiled(profile_path: str = None, profiler=None):
+    """
+    Profile the code in the with block.
+    For a sampling profiler like py-spy, run it from outside instead, eg `py-spy record -- python main.py ...`.
+    The pid in each line of the report says which process it came from
+    :param profile_path: where to save the profile, eg for `python -m pstats` or snakeviz. If None and there's no
+    profiler, nothing is profiled
+    :param profiler: anything with enable() and disable() methods. Defaults to a cProfile.Profile. It's saved to
+    profile_path if it has a dump_stats() method
+    :return:
+    """
+    if profiler is None and profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+    if profiler is None:
+        yield None
+        return
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if profile_path is not None and hasattr(profiler, "dump_stats"):
+            profiler.dump_stats(profile_path)
 
 
 def get_filename(file_path: str) -> str:
@@ -24,211 +323,1690 @@ def get_filename(file_path: str) -> str:
     return file_path.split(os.sep)[-1].split(".")[0]
 
 
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "w"):
+    """
+    Write to a temporary file next to path, and only move it over path once it has all been written, so a crash
+    part-way through never leaves path empty or cut off for the next run to trust. The temporary file is named after
+    the process, so several processes can write the same path at once
+    :param path:
+    :param mode: "w" for text or "wb" for bytes
+    :return: yields the open temporary file
+    """
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, mode) as temp_file:
+            yield temp_file
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
 def sorted_dictionary(dictionary: dict) -> dict:
+    # Ties are sorted alphabetically, so the output doesn't depend on the order tokens were counted in
     sorted_tokens = sorted(zip(list(dictionary.keys()), list(dictionary.values())),
-                           key=lambda x: x[1],
-                           reverse=True)
+                           key=lambda x: (-x[1], x[0]))
     return {key: value for key, value in sorted_tokens}
 
 
-def get_text_from_pdf(root: str, pdf_path: str, verbose: bool = True, reuse=True) -> list:
+def top_k_dictionary(dictionary: dict, top_k: int = None) -> dict:
+    """
+    The top_k highest valued items of dictionary, in the same order as sorted_dictionary(). Uses a heap, so it's much
+    faster than sorting everything when only a few items are needed
+    :param dictionary:
+    :param top_k: the number of items to keep. If None, keep everything
+    :return:
+    """
+    if top_k is None:
+        return sorted_dictionary(dictionary)
+    return {key: value for key, value in heapq.nsmallest(top_k, dictionary.items(), key=lambda x: (-x[1], x[0]))}
+
+
+def vocabulary_sidecar_path(json_path: str) -> str:
+    """
+    :param json_path:
+    :return: where the full vocabulary of json_path is saved, see write_vocabulary_sidecar()
+    """
+    return os.path.splitext(json_path)[0] + ".vocab"
+
+
+def write_vocabulary_sidecar(sidecar_path: str, frequencies: dict) -> None:
+    """
+    Save every (token : frequency) pair to a compact binary file that can be memory-mapped. The layout is
+    VOCABULARY_MAGIC, the number of tokens n as an int64, n + 1 int64 offsets into the token bytes, n int64
+    frequencies, and then the utf-8 bytes of every token. Tokens are sorted, so they can be binary searched
+    :param sidecar_path:
+    :param frequencies:
+    :rtype: None
+    """
+    import numpy as np
+    tokens = sorted(frequencies)
+    encoded = [token.encode() for token in tokens]
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum([len(token) for token in encoded], out=offsets[1:])
+    counts = np.array([frequencies[token] for token in tokens], dtype=np.int64)
+
+    with atomic_write(sidecar_path, "wb") as sidecar:
+        sidecar.write(VOCABULARY_MAGIC)
+        sidecar.write(np.array([len(tokens)], dtype=np.int64).tobytes())
+        sidecar.write(offsets.tobytes())
+        sidecar.write(counts.tobytes())
+        sidecar.write(b"".join(encoded))
+
+
+def read_vocabulary_sidecar(sidecar_path: str) -> tuple:
+    """
+    Memory-map a file made by write_vocabulary_sidecar(), without reading it all in
+    :param sidecar_path:
+    :return: (offsets, counts, token_bytes) arrays. Token i is token_bytes[offsets[i]:offsets[i + 1]]
+    """
+    import numpy as np
+    raw = np.memmap(sidecar_path, dtype=np.uint8, mode="r")
+    if raw[:len(VOCABULARY_MAGIC)].tobytes() != VOCABULARY_MAGIC:
+        raise ValueError("'{}' isn't a vocabulary file".format(sidecar_path))
+    start = len(VOCABULARY_MAGIC)
+    num_tokens = int(raw[start:start + 8].view(np.int64)[0])
+    start += 8
+    offsets = raw[start:start + 8 * (num_tokens + 1)].view(np.int64)
+    start += 8 * (num_tokens + 1)
+    counts = raw[start:start + 8 * num_tokens].view(np.int64)
+    start += 8 * num_tokens
+    return offsets, counts, raw[start:]
+
+
+def lookup_vocabulary_sidecar(sidecar: tuple, token: str) -> int:
+    """
+    Binary search a memory-mapped vocabulary for token
+    :param sidecar: see read_vocabulary_sidecar()
+    :param token:
+    :return: the frequency of token, or 0 if it isn't there
+    """
+    offsets, counts, token_bytes = sidecar
+    needle = token.encode()
+    low, high = 0, len(counts)
+    while low < high:
+        middle = (low + high) // 2
+        if token_bytes[offsets[middle]:offsets[middle + 1]].tobytes() < needle:
+            low = middle + 1
+        else:
+            high = middle
+    if low < len(counts) and token_bytes[offsets[low]:offsets[low + 1]].tobytes() == needle:
+        return int(counts[low])
+    return 0
+
+
+def load_frequencies(json_path: str) -> dict:
+    """
+    Load every (token : frequency) pair of a summary. This comes from the vocabulary sidecar if there is one,
+    since the json file might only have the top few tokens
+    :param json_path:
+    :return:
+    """
+    sidecar_path = vocabulary_sidecar_path(json_path)
+    if not os.path.exists(sidecar_path):
+        with open(json_path, "r") as json_file:
+            return json.load(json_file)
+
+    offsets, counts, token_bytes = read_vocabulary_sidecar(sidecar_path)
+    token_bytes = token_bytes.tobytes()
+    offsets = offsets.tolist()
+    tokens = [token_bytes[offsets[i]:offsets[i + 1]].decode() for i in range(len(counts))]
+    return dict(zip(tokens, counts.tolist()))
+
+
+def write_summary(json_path: str, frequencies: dict, top_k: int = None, compact: bool = False,
+                  sidecar: bool = False) -> None:
     """
-    Use Tesseract OCR to get the text from filename. PDFs are converted pagewise into
-    jpegs and saved in savepath
+    Save (token : frequency) pairs to json_path, sorted by frequency
+    :param json_path:
+    :param frequencies:
+    :param top_k: if not None, only save the top_k most frequent tokens to the json file
+    :param compact: if True, leave out all the whitespace in the json file
+    :param sidecar: if True, also save every token to a binary file next to json_path, see write_vocabulary_sidecar()
+    :rtype: None
+    """
+    with atomic_write(json_path) as json_file:
+        if compact:
+            json.dump(top_k_dictionary(frequencies, top_k), json_file, separators=(",", ":"))
+        else:
+            json.dump(top_k_dictionary(frequencies, top_k), json_file, indent=2)
+
+    sidecar_path = vocabulary_sidecar_path(json_path)
+    if sidecar:
+        write_vocabulary_sidecar(sidecar_path, frequencies)
+    elif os.path.exists(sidecar_path):
+        # Otherwise load_frequencies() would find the old one
+        os.remove(sidecar_path)
+
+
+def fancy_count(needle: str, haystack: str) -> int:
+    """
+    The original counting function: the number of non-overlapping times needle appears anywhere in haystack.
+    Calling this once per token is quadratic, so it's only kept as a reference for count_ngrams()
+    :param needle:
+    :param haystack:
+    :return:
+    """
+    # Fuzzy matching of badly OCR'd words is done separately, see build_fuzzy_index()
+    return haystack.count(needle)
+
+
+def sliding_windows(words):
+    """
+    Generator over every position in words, giving the word there and the two words after it
+    :param words: any iterable of words
+    :return: yields (word, next_word, next_next_word) tuples, with None past the end of words
+    """
+    window = []
+    for word in words:
+        window.append(word)
+        if len(window) == 3:
+            yield tuple(window)
+            window.pop(0)
+    while window:
+        yield tuple(window) + (None,) * (3 - len(window))
+        window.pop(0)
+
+
+def count_ngrams(split_text, stopwords: set, mode: str = "substring") -> dict:
+    """
+    Count every 1-, 2- and 3-gram in split_text in one sliding-window pass over the words.
+    Unigrams shorter than 3 characters and any n-gram in stopwords are excluded.
+
+    mode="token" only counts exact, whole-word occurrences of each n-gram.
+    mode="substring" gives the same counts as calling fancy_count(token, " ".join(split_text)) for every token,
+    so "recursion" is also counted inside "recursions", and "base case" inside "database cases".
+    Like str.count(), overlapping occurrences of the same token are only counted once.
+    :param split_text: the normalised text, split on single spaces. Either a list, or a function that returns a fresh
+    iterator over the words each time it's called (see tokenize_file()), so they never all have to be in memory
+    :param stopwords: tokens to exclude
+    :param mode: one of COUNT_MODES
+    :return: dict of (token : frequency) pairs, unsorted
+    """
+    if mode not in COUNT_MODES:
+        raise ValueError("Unknown count mode '{}', expected one of {}".format(mode, COUNT_MODES))
+    words = split_text if callable(split_text) else lambda: iter(split_text)
+
+    if mode == "token":
+        frequencies = {}
+        for word, next_word, next_next_word in sliding_windows(words()):
+            grams = [word] if not word.isspace() and len(word) > 2 else []
+            if next_word is not None:
+                grams.append(word + " " + next_word)
+            if next_next_word is not None:
+                grams.append(word + " " + next_word + " " + next_next_word)
+            for gram in grams:
+                frequencies[gram] = frequencies.get(gram, 0) + 1
+        for stopword in stopwords:
+            frequencies.pop(stopword, None)
+        return frequencies
+
+    # Substring mode takes two passes: one to find the vocabulary, and one to match it against the text
+    word_freqs = {}
+    ngrams = set()
+    for word, next_word, next_next_word in sliding_windows(words()):
+        word_freqs[word] = word_freqs.get(word, 0) + 1
+        if next_word is not None:
+            ngrams.add((word, next_word))
+        if next_next_word is not None:
+            ngrams.add((word, next_word, next_next_word))
+
+    # Unigrams can't contain a space, so they can only ever match inside a single word
+    unigrams = {word for word in word_freqs if not word.isspace() and len(word) > 2 and word not in stopwords}
+    frequencies = dict.fromkeys(unigrams, 0)
+    lengths = sorted({len(word) for word in unigrams})
+    for word, freq in word_freqs.items():
+        seen = set()
+        for start in range(len(word)):
+            for length in lengths:
+                if start + length > len(word):
+                    break
+                needle = word[start:start + length]
+                if needle in unigrams and needle not in seen:
+                    seen.add(needle)
+                    frequencies[needle] += freq * word.count(needle)
+
+    # A 2- or 3-gram "a b c" matches wherever a word ending in "a" is followed by "b" and then a word starting with "c"
+    ngrams = {ngram for ngram in ngrams if " ".join(ngram) not in stopwords}
+    first_words = {ngram[0] for ngram in ngrams}
+    last_words = {ngram[-1] for ngram in ngrams}
+    suffixes, prefixes = {}, {}
+    ngram_freqs = dict.fromkeys(ngrams, 0)
+    # (word index, character offset) of the end of the last counted occurrence of each n-gram
+    last_end = {}
+    for j, window in enumerate(sliding_windows(words())):
+        word = window[0]
+        if window[1] is None:
+            break
+        if word not in suffixes:
+            suffixes[word] = [word[i:] for i in range(len(word) + 1) if word[i:] in first_words]
+        for first in suffixes[word]:
+            for size in (2, 3):
+                last_word = window[size - 1]
+                if last_word is None:
+                    break
+                if last_word not in prefixes:
+                    prefixes[last_word] = [last_word[:i] for i in range(len(last_word) + 1)
+                                           if last_word[:i] in last_words]
+                middle = window[1:size - 1]
+                for last in prefixes[last_word]:
+                    ngram = (first,) + middle + (last,)
+                    if ngram not in ngram_freqs:
+                        continue
+                    if ngram in last_end and (j, len(word) - len(first)) < last_end[ngram]:
+                        # overlaps with the previous occurrence
+                        continue
+                    last_end[ngram] = (j + size - 1, len(last))
+                    ngram_freqs[ngram] += 1
+
+    for ngram, freq in ngram_freqs.items():
+        frequencies[" ".join(ngram)] = freq
+    return frequencies
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    The number of insertions, deletions, substitutions and swaps of neighbouring characters needed to turn a into b
+    (the optimal string alignment distance)
+    :param a:
+    :param b:
+    :param max_distance: stop early once the distance is definitely more than this
+    :return: the distance, or max_distance + 1 if it's more than max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+def deletes(word: str, max_distance: int) -> set:
+    """
+    Every string that can be made by deleting up to max_distance characters from word, including word itself
+    :param word:
+    :param max_distance:
+    :return:
+    """
+    variants = {word}
+    edge = {word}
+    for _ in range(max_distance):
+        edge = {variant[:i] + variant[i + 1:] for variant in edge for i in range(len(variant))} - variants
+        variants |= edge
+    return variants
+
+
+def build_fuzzy_index(frequencies: dict, max_distance: int = 1, min_length: int = FUZZY_MIN_LENGTH) -> dict:
+    """
+    Index the words of a vocabulary so that OCR-mangled words ("recurslon", "recursi0n") can be mapped back to them
+    quickly. This is a symmetric delete index: two words are within edit distance d only if deleting at most d
+    characters from each gives the same string, so a lookup only has to generate the deletes of the mangled word
+    instead of comparing it against every word in the vocabulary
+    :param frequencies: (word : frequency) pairs. Multi-word tokens are split into their words
+    :param max_distance: the largest edit distance that still counts as a match
+    :param min_length: words shorter than this are only ever matched exactly, since they're too ambiguous
+    :return: the index, to be passed to fuzzy_lookup()
+    """
+    word_frequencies = {}
+    for token, frequency in frequencies.items():
+        for word in token.split(" "):
+            word_frequencies[word] = word_frequencies.get(word, 0) + frequency
+
+    variants = {}
+    for word in word_frequencies:
+        if len(word) >= min_length:
+            for variant in deletes(word, max_distance):
+                variants.setdefault(variant, []).append(word)
+    return {
+        "frequencies": word_frequencies,
+        "variants": variants,
+        "max_distance": max_distance,
+        "min_length": min_length,
+        # The result of every lookup so far, since the same mangled words tend to come up again and again
+        "cache": {},
+    }
+
+
+def fuzzy_lookup(fuzzy_index: dict, word: str):
+    """
+    Find the vocabulary word that word is most likely an OCR error of. The closest word wins, then the most frequent,
+    then the first alphabetically
+    :param fuzzy_index: see build_fuzzy_index()
+    :param word:
+    :return: the vocabulary word, or None if none are close enough
+    """
+    cache = fuzzy_index["cache"]
+    if word in cache:
+        return cache[word]
+
+    if word in fuzzy_index["frequencies"]:
+        match = word
+    elif len(word) < fuzzy_index["min_length"] - fuzzy_index["max_distance"]:
+        match = None
+    else:
+        max_distance = fuzzy_index["max_distance"]
+        candidates = set()
+        for variant in deletes(word, max_distance):
+            candidates.update(fuzzy_index["variants"].get(variant, ()))
+        best = None
+        for candidate in candidates:
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                key = (distance, -fuzzy_index["frequencies"][candidate], candidate)
+                if best is None or key < best:
+                    best = key
+        match = best[2] if best is not None else None
+
+    cache[word] = match
+    return match
+
+
+def canonicalise_frequencies(frequencies: dict, fuzzy_index: dict) -> dict:
+    """
+    Map every token in frequencies onto the vocabulary of fuzzy_index, word by word, adding up the frequencies of
+    tokens that end up the same. Words with no close match are left as they are
+    :param frequencies: (token : frequency) pairs
+    :param fuzzy_index: see build_fuzzy_index()
+    :return:
+    """
+    canonical = {}
+    for token, frequency in frequencies.items():
+        words = [fuzzy_lookup(fuzzy_index, word) or word for word in token.split(" ")]
+        token = " ".join(words)
+        canonical[token] = canonical.get(token, 0) + frequency
+    return canonical
+
+
+def tesseract_ocr(image: PILImage.Image, timeout: float = 0) -> str:
+    """
+    Use Tesseract OCR to get the text from a single page image.
+    Any other OCR callable passed to get_text_from_pdf() or pdfs_to_texts() must take the same arguments
     Further Tesseract OCR usage instructions: https://anaconda.org/jiayi_anaconda/pytesseract
-    :param root:
-    :param reuse:
-    :param pdf_path: pdf to get the text from
-    :param verbose: Enable logging to standard output. True by default
-    :return: a list of strings, each string being one page of the pdf
+    :param image: the page to read
+    :param timeout: seconds before tesseract is killed and TimeoutError raised. 0 means no timeout
+    :return: the text on the page
+    """
+    import pytesseract
+    # Make sure pytesseract knows where tesseract is stored. This has to happen here and not at import time,
+    # since OCR might be running in a worker process
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    try:
+        return pytesseract.image_to_string(image, config=TESSERACT_CONFIG, timeout=timeout)
+    except RuntimeError as error:
+        if "timeout" in str(error).lower():
+            raise TimeoutError(str(error))
+        raise
+
+
+def ocr_image(image: PILImage.Image, description: str, ocr=tesseract_ocr, timeout: float = 0,
+              cache_dir: str = None) -> tuple:
+    """
+    Run ocr on image, or get its text from the cache in cache_dir if it has been OCR'd before.
+    If the OCR times out, a warning is printed and the page is left empty
+    :param image:
+    :param description: how to refer to the image in the warning
+    :param ocr: the OCR callable, see tesseract_ocr()
+    :param timeout: per-page timeout in seconds, 0 means no timeout
+    :param cache_dir: the OCR cache, or None to not use a cache
+    :return: (page_key, text) where page_key is the page_cache_key(), or None if the page isn't in the cache
+    """
+    with stage("ocr", description, cached=False) as record:
+        page_key = None
+        if cache_dir is not None:
+            page_key = page_cache_key(image, ocr_settings(ocr))
+            text = read_cached_page(cache_dir, page_key)
+            if text is not None:
+                record["cached"] = True
+                return page_key, text
+
+        try:
+            text = ocr(image, timeout=timeout)
+        except TimeoutError:
+            print("OCR of '{}' timed out after {}s, leaving the page empty".format(description, timeout))
+            record["timed_out"] = True
+            # Don't cache the empty page, so it gets another chance next time
+            return None, ""
+
+        if cache_dir is not None:
+            write_cached_page(cache_dir, page_key, text)
+        return page_key, text
+
+
+def page_number_key(image_path: str) -> tuple:
+    """
+    Sort key for page images, so that name-10.png comes after name-9.png
+    :param image_path:
+    :return:
+    """
+    page = re.search(r"-([0-9]+)$", get_filename(image_path))
+    return (int(page.group(1)) if page else -1), image_path
+
+
+@functools.lru_cache(maxsize=None)
+def tesseract_version() -> str:
+    """
+    Asks tesseract once per process, since ocr_settings() is called for every page
+    :return: the version of the tesseract at TESSERACT_CMD, or "unknown" if it can't be run
+    """
+    try:
+        import pytesseract
+        pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+        return str(pytesseract.get_tesseract_version())
+    except (ImportError, OSError):
+        return "unknown"
+
+
+def ocr_settings(ocr=tesseract_ocr) -> dict:
+    """
+    Everything that changes the text OCR produces for the same page, so it can be part of the cache key.
+    The OCR callable is named without its module, since that is "__main__", "main" or "__mp_main__" depending on
+    how the program was started and whether this is a worker process
+    :param ocr: the OCR callable, see tesseract_ocr()
+    :return:
+    """
+    if ocr.__qualname__ != tesseract_ocr.__qualname__:
+        return {"resolution": RESOLUTION, "ocr": ocr.__qualname__}
+    return {
+        "resolution": RESOLUTION,
+        "ocr": "tesseract",
+        "tesseract_version": tesseract_version(),
+        "tesseract_config": TESSERACT_CONFIG,
+    }
+
+
+def update_digest(digest, file_path: str):
+    """
+    Feed the contents of file_path into a hashlib digest, without reading the whole file into memory
+    :param digest:
+    :param file_path:
+    :return: digest
     """
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest
 
-    # Make sure pytesseract knows where tesseract is stored
-    # CHANGE THIS LINE to be the absolute path to the tesseract unix executable file
-    pytesseract.pytesseract.tesseract_cmd = '/anaconda3/envs/MemosToNotes3/bin/tesseract'
 
-    # First convert the pdf to an image
-    with WandImage(filename=pdf_path, resolution=200) as image:
-        image.compression_quality = 60
+def file_sha256(file_path: str) -> str:
+    """
+    :param file_path:
+    :return: the sha256 of the contents of file_path
+    """
+    return update_digest(hashlib.sha256(), file_path).hexdigest()
 
-        # Enforce a white background, otherwise some powerpoints just become entirely black images
-        image.background_color = Color("white")
-        image.alpha_channel = 'remove'
 
-        # Each pdf has to be split into multiple .pngs, so each pdf gets a directory in root/pngs/
-        images_directory = os.path.join(os.path.join(root, "pngs"), get_filename(pdf_path))
+def pdf_cache_key(pdf_path: str, settings: dict) -> str:
+    """
+    Hash the contents of pdf_path together with the OCR settings, so a renamed pdf has the same key
+    and a replaced pdf with the same name doesn't
+    :param pdf_path:
+    :param settings: see ocr_settings()
+    :return:
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    return update_digest(digest, pdf_path).hexdigest()
+
+
+def page_cache_key(image: PILImage.Image, settings: dict) -> str:
+    """
+    Hash the pixels of a page image together with the OCR settings
+    :param image:
+    :param settings: see ocr_settings()
+    :return:
+    """
+    digest = hashlib.sha256(json.dumps(settings, sort_keys=True).encode())
+    digest.update("{} {}".format(image.mode, image.size).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def load_ocr_manifest(cache_dir: str) -> dict:
+    """
+    Read the manifest of the OCR cache in cache_dir. It has two parts:
+    "pdfs" maps a pdf_cache_key() to the names the pdf has been seen under, and the page_cache_key() and source
+    (see record_cached_pdf()) of every page,
+    "pages" maps a page_cache_key() to the size of its cached text and when it was last used.
+    The text of each page is in cache_dir/pages/__page_key__.txt
+    :param cache_dir:
+    :return:
+    """
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        return {"pdfs": {}, "pages": {}}
+    with open(manifest_path, "r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def save_ocr_manifest(cache_dir: str, manifest: dict) -> None:
+    """
+    Write the manifest of the OCR cache in cache_dir, replacing the old one in a single step
+    :param cache_dir:
+    :param manifest: see load_ocr_manifest()
+    :rtype: None
+    """
+    with atomic_write(os.path.join(cache_dir, "manifest.json")) as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def read_cached_page(cache_dir: str, page_key: str):
+    """
+    :param cache_dir:
+    :param page_key: see page_cache_key()
+    :return: the cached text of the page, or None if it isn't cached
+    """
+    page_path = os.path.join(cache_dir, "pages", page_key + ".txt")
+    if not os.path.exists(page_path):
+        return None
+    with open(page_path, "r") as page_file:
+        return page_file.read()
+
+
+def write_cached_page(cache_dir: str, page_key: str, text: str) -> None:
+    """
+    Save the text of a page to the cache. Safe to call from several worker processes at once
+    :param cache_dir:
+    :param page_key: see page_cache_key()
+    :param text:
+    :rtype: None
+    """
+    pages_directory = os.path.join(cache_dir, "pages")
+    os.makedirs(pages_directory, exist_ok=True)
+    with atomic_write(os.path.join(pages_directory, page_key + ".txt")) as page_file:
+        page_file.write(text)
+
+
+def read_cached_pdf(cache_dir: str, manifest: dict, pdf_key: str):
+    """
+    :param cache_dir:
+    :param manifest: see load_ocr_manifest()
+    :param pdf_key: see pdf_cache_key()
+    :return: the cached text of every page of the pdf, or None if any of them aren't cached
+    """
+    if pdf_key not in manifest["pdfs"]:
+        return None
+    pdf_text = []
+    for page_key in manifest["pdfs"][pdf_key]["pages"]:
+        text = read_cached_page(cache_dir, page_key)
+        if text is None:
+            return None
+        pdf_text.append(text)
+    return pdf_text
+
+
+def record_cached_pdf(cache_dir: str, manifest: dict, pdf_key: str, pdf_path: str, page_keys: list,
+                      sources: list, settings: dict) -> None:
+    """
+    Add a pdf and its pages to the manifest, and mark them as just used
+    :param cache_dir:
+    :param manifest: see load_ocr_manifest()
+    :param pdf_key: see pdf_cache_key()
+    :param pdf_path:
+    :param page_keys: the page_cache_key() of every page, in order
+    :param sources: where the text of every page came from, either "text layer" or "ocr"
+    :param settings: see ocr_settings()
+    :rtype: None
+    """
+    now = time.time()
+    entry = manifest["pdfs"].setdefault(pdf_key, {"names": [], "settings": settings})
+    entry["pages"] = page_keys
+    entry["sources"] = sources
+    entry["last_used"] = now
+    if get_filename(pdf_path) not in entry["names"]:
+        entry["names"].append(get_filename(pdf_path))
+    for page_key in page_keys:
+        page_path = os.path.join(cache_dir, "pages", page_key + ".txt")
+        manifest["pages"][page_key] = {"size": os.path.getsize(page_path), "last_used": now}
+
+
+def evict_ocr_cache(cache_dir: str, manifest: dict, max_bytes: int = None, max_age_days: float = None,
+                    verbose: bool = True) -> None:
+    """
+    Delete cached pages that haven't been used in max_age_days, and then the least recently used pages until
+    the cache is no bigger than max_bytes. Pdfs that lose a page are dropped from the manifest too
+    :param cache_dir:
+    :param manifest: see load_ocr_manifest()
+    :param max_bytes: the maximum total size of the cached page texts, or None for no limit
+    :param max_age_days: the maximum time since a page was last used, or None for no limit
+    :param verbose: if True, log progress to the console
+    :rtype: None
+    """
+    pages = sorted(manifest["pages"].items(), key=lambda item: item[1]["last_used"])
+    total_bytes = sum(page["size"] for _, page in pages)
+    oldest_allowed = time.time() - max_age_days * 24 * 60 * 60 if max_age_days is not None else None
+
+    evicted = set()
+    for page_key, page in pages:
+        too_old = oldest_allowed is not None and page["last_used"] < oldest_allowed
+        too_big = max_bytes is not None and total_bytes > max_bytes
+        if not too_old and not too_big:
+            break
+        evicted.add(page_key)
+        total_bytes -= page["size"]
+        del manifest["pages"][page_key]
+        page_path = os.path.join(cache_dir, "pages", page_key + ".txt")
+        if os.path.exists(page_path):
+            os.remove(page_path)
+
+    if evicted:
+        if verbose:
+            print("Evicted {} pages from the OCR cache in {}".format(len(evicted), cache_dir))
+        manifest["pdfs"] = {pdf_key: pdf for pdf_key, pdf in manifest["pdfs"].items()
+                            if evicted.isdisjoint(pdf["pages"])}
+
+
+def extract_text_layer(pdf_path: str):
+    """
+    Get the text that is already embedded in pdf_path, as it is in pdfs exported from PowerPoint or LaTeX.
+    This is much faster than OCR, but scanned pdfs don't have a text layer
+    :param pdf_path:
+    :return: the text of each page, with None for pages that don't have a usable text layer.
+    None if the pdf can't be read at all
+    """
+    from pypdf import PdfReader
+    try:
+        reader = PdfReader(pdf_path)
+        pages = list(reader.pages)
+    except Exception as error:
+        print("Couldn't read the text layer of '{}' ({}), using OCR instead".format(pdf_path, error))
+        return None
+
+    page_texts = []
+    for page_number, page in enumerate(pages):
+        try:
+            text = page.extract_text() or ""
+        except Exception as error:
+            # pypdf raises all sorts of errors on malformed content streams, so just OCR this page instead
+            print("Couldn't read the text layer of page {} of '{}' ({!r}), using OCR instead".format(
+                page_number + 1, pdf_path, error))
+            text = ""
+        # Image-only pages often still have a few stray characters, like page numbers
+        if len(re.findall(r"[A-Za-z]{3,}", text)) < MIN_TEXT_LAYER_WORDS:
+            page_texts.append(None)
+        else:
+            page_texts.append(text + "\n")
+    return page_texts
+
+
+def text_page_cache_key(text: str) -> str:
+    """
+    Cache key for a page whose text came from the pdf's text layer instead of OCR
+    :param text:
+    :return:
+    """
+    return hashlib.sha256(("text layer\n" + text).encode()).hexdigest()
+
+
+def count_pdf_pages(pdf_path: str) -> int:
+    """
+    Count the pages in pdf_path without rasterizing them
+    :param pdf_path:
+    :return:
+    """
+    from wand.image import Image as WandImage
+    with WandImage.ping(filename=pdf_path) as pdf:
+        return len(pdf.sequence)
+
+
+def rasterize_pdf_pages(pdf_path: str, first_page: int = 0, last_page: int = None, pages_per_read: int = 1):
+    """
+    Generator that rasterizes pdf_path a few pages at a time, so that at most pages_per_read pages are
+    ever held in memory. The yielded images are closed as soon as the next one is requested.
+    :param pdf_path:
+    :param first_page: the first page to rasterize, counting from 0
+    :param last_page: stop before this page. Defaults to the end of the pdf
+    :param pages_per_read: how many pages ImageMagick decodes at once
+    :return: yields (page_number, image) tuples, in page order
+    """
+    from PIL import Image as PILImage
+    from wand.color import Color
+    from wand.image import Image as WandImage
+    if last_page is None:
+        last_page = count_pdf_pages(pdf_path)
+
+    for window_start in range(first_page, last_page, pages_per_read):
+        window_end = min(window_start + pages_per_read, last_page) - 1
+        with WandImage(filename="{}[{}-{}]".format(pdf_path, window_start, window_end),
+                       resolution=RESOLUTION) as window:
+            for offset, frame in enumerate(window.sequence):
+                with WandImage(image=frame) as page:
+                    # Enforce a white background, otherwise some powerpoints just become entirely black images
+                    page.background_color = Color("white")
+                    page.alpha_channel = 'remove'
+                    # Uncompressed, since it never touches the disk
+                    blob = page.make_blob("ppm")
+                with PILImage.open(io.BytesIO(blob)) as image:
+                    yield window_start + offset, image
+
+
+def ocr_page(page, ocr=tesseract_ocr, timeout: float = 0, cache_dir: str = None) -> tuple:
+    """
+    Get the text of a single page, either from an image file or straight from the pdf.
+    This is a module level function so that it can be sent to worker processes
+    :param page: either the path to an image file, or a (pdf_path, page_number, png_path) tuple. In the second case
+    the page is rasterized here, and also saved to png_path if that isn't None
+    :param ocr: the OCR callable, see tesseract_ocr()
+    :param timeout: per-page timeout in seconds, 0 means no timeout
+    :param cache_dir: the OCR cache, or None to not use a cache
+    :return: (page_key, text), see ocr_image()
+    """
+    from PIL import Image as PILImage
+    if isinstance(page, str):
+        with PILImage.open(page) as image:
+            return ocr_image(image, page, ocr=ocr, timeout=timeout, cache_dir=cache_dir)
+
+    pdf_path, page_number, png_path = page
+    # Closed as soon as the page is returned, so the rasterize record is written now rather than whenever the
+    # generator is garbage collected
+    with contextlib.closing(timed_iter(rasterize_pdf_pages(pdf_path, page_number, page_number + 1), "rasterize",
+                                       "{}[{}]".format(pdf_path, page_number))) as images:
+        for _, image in images:
+            if png_path is not None:
+                image.save(png_path)
+            description = "{}[{}]".format(pdf_path, page_number)
+            return ocr_image(image, description, ocr=ocr, timeout=timeout, cache_dir=cache_dir)
+    return None, ""
+
+
+def rasterize_pdf(root: str, pdf_path: str, verbose: bool = True, reuse: bool = True) -> list:
+    """
+    Convert pdf_path pagewise into pngs, saved in root/pngs/__filename__/
+    This decodes the whole pdf at once, see rasterize_pdf_pages() for a version with bounded memory
+    :param root:
+    :param pdf_path: pdf to convert
+    :param verbose: Enable logging to standard output. True by default
+    :param reuse: If True and the pngs directory already has images in it, don't convert the pdf again
+    :return: the paths of the page images, in page order
+    """
+    from wand.color import Color
+    from wand.image import Image as WandImage
+    # Each pdf has to be split into multiple .pngs, so each pdf gets a directory in root/pngs/
+    images_directory = os.path.join(os.path.join(root, "pngs"), get_filename(pdf_path))
+    os.makedirs(images_directory, exist_ok=True)
+
+    if not reuse or len(os.listdir(images_directory)) == 0:
+        # First convert the pdf to an image
+        with stage("rasterize", pdf_path) as record, WandImage(filename=pdf_path, resolution=RESOLUTION) as image:
+            record["items"] = len(image.sequence)
+            image.compression_quality = 60
+
+            # Enforce a white background, otherwise some powerpoints just become entirely black images
+            image.background_color = Color("white")
+            image.alpha_channel = 'remove'
 
-        os.makedirs(images_directory, exist_ok=True)
-        if not reuse or len(os.listdir(images_directory)) == 0:
             # Save each set of pngs in their own directory: root/pngs/__filename__/1.png, 2.pngs, etc
             image_path = os.path.join(images_directory, get_filename(pdf_path) + ".png")
             if verbose:
                 print("Saving as image file: " + image_path)
             image.save(filename=image_path)
 
-    # now get all the .png files, and use tesseract on them
-    images = sorted(glob.glob(os.path.join(images_directory, "*.png")))
-    pdf_text = []
+    return sorted(glob.glob(os.path.join(images_directory, "*.png")), key=page_number_key)
+
+
+def get_pdf_pages(root: str, pdf_path: str, verbose: bool = True, reuse: bool = True, stream: bool = False,
+                  keep_pngs: bool = True, page_numbers: list = None) -> list:
+    """
+    Get the pages of pdf_path in a form that ocr_page() accepts
+    :param root:
+    :param pdf_path:
+    :param verbose: Enable logging to standard output. True by default
+    :param reuse: If True, reuse the pngs from a previous run instead of rasterizing the pdf again. Not used if stream
+    :param stream: If True, the pages are rasterized one by one when they are OCR'd, instead of all at once up front
+    :param keep_pngs: If stream, whether to also save each page to root/pngs/__filename__/
+    :param page_numbers: If not None, only get these pages (counting from 0). Implies stream
+    :return: a list of image paths, or of (pdf_path, page_number, png_path) tuples if stream
+    """
+    if not stream and page_numbers is None:
+        return rasterize_pdf(root, pdf_path, verbose=verbose, reuse=reuse)
+
+    images_directory = os.path.join(root, "pngs", get_filename(pdf_path))
+    if keep_pngs:
+        os.makedirs(images_directory, exist_ok=True)
+    if page_numbers is None:
+        page_numbers = range(count_pdf_pages(pdf_path))
+    pages = []
+    for page_number in page_numbers:
+        png_path = None
+        if keep_pngs:
+            png_path = os.path.join(images_directory, "{}-{}.png".format(get_filename(pdf_path), page_number))
+        pages.append((pdf_path, page_number, png_path))
+    return pages
+
+
+def ocr_pdf(root: str, pdf_path: str, verbose: bool = True, reuse=True, ocr=tesseract_ocr, timeout: float = 0,
+            stream: bool = False, keep_pngs: bool = True, pages_per_read: int = 1, cache_dir: str = None):
+    """
+    Generator version of get_text_from_pdf(), which also gives the cache key of each page
+    :return: yields (page_key, text) for each page of the pdf, see ocr_image()
+    """
+    if stream:
+        images_directory = os.path.join(root, "pngs", get_filename(pdf_path))
+        if keep_pngs:
+            os.makedirs(images_directory, exist_ok=True)
+        for page_number, image in timed_iter(rasterize_pdf_pages(pdf_path, pages_per_read=pages_per_read),
+                                             "rasterize", pdf_path):
+            if verbose:
+                print("\tExtracting text from page {} of {}... ".format(page_number + 1, pdf_path), end="")
+            if keep_pngs:
+                image.save(os.path.join(images_directory, "{}-{}.png".format(get_filename(pdf_path), page_number)))
+            description = "{}[{}]".format(pdf_path, page_number)
+            yield ocr_image(image, description, ocr=ocr, timeout=timeout, cache_dir=cache_dir)
+            if verbose:
+                print("Done")
+        return
+
+    images = rasterize_pdf(root, pdf_path, verbose=verbose, reuse=reuse)
+
+    # now use OCR on each of the .png files
     for i, image in enumerate(images, 1):
         if verbose:
             print("\tExtracting text from {} (file {} out of {})... ".format(image, i, len(images)), end="")
-        pdf_text.append(pytesseract.image_to_string(PILImage.open(image)))
+        yield ocr_page(image, ocr=ocr, timeout=timeout, cache_dir=cache_dir)
         if verbose:
             print("Done")
-    return pdf_text
 
 
-def pdfs_to_texts(root: str, verbose: bool = True, reuse: bool = True) -> None:
+def get_text_from_pdf(root: str, pdf_path: str, verbose: bool = True, reuse=True, ocr=tesseract_ocr,
+                      timeout: float = 0, stream: bool = False, keep_pngs: bool = True,
+                      pages_per_read: int = 1, cache_dir: str = None) -> list:
+    """
+    Use OCR to get the text from filename. PDFs are converted pagewise into
+    pngs and saved in root/pngs/
+    :param root:
+    :param reuse:
+    :param pdf_path: pdf to get the text from
+    :param verbose: Enable logging to standard output. True by default
+    :param ocr: the OCR callable, see tesseract_ocr()
+    :param timeout: per-page OCR timeout in seconds, 0 means no timeout
+    :param stream: If True, rasterize pages_per_read pages at a time and OCR them straight from memory, so memory
+    use doesn't grow with the length of the pdf
+    :param keep_pngs: If stream, whether to also save each page to root/pngs/__filename__/
+    :param pages_per_read: If stream, how many pages are rasterized at once
+    :param cache_dir: If not None, pages that are in this OCR cache aren't OCR'd again. See load_ocr_manifest()
+    :return: a list of strings, each string being one page of the pdf
+    """
+    return [text for _, text in ocr_pdf(root, pdf_path, verbose=verbose, reuse=reuse, ocr=ocr, timeout=timeout,
+                                        stream=stream, keep_pngs=keep_pngs, pages_per_read=pages_per_read,
+                                        cache_dir=cache_dir)]
+
+
+def ocr_pages_in_parallel(pages: list, workers: int, verbose: bool = True, ocr=tesseract_ocr,
+                          timeout: float = 0, cache_dir: str = None, on_page=None) -> list:
+    """
+    Run OCR on every page in pages, spread over a pool of worker processes
+    :param pages: the pages, as accepted by ocr_page()
+    :param workers: the number of worker processes
+    :param verbose: if True, log progress to the console
+    :param ocr: the OCR callable, see tesseract_ocr(). Has to be defined at module level so it can be pickled
+    :param timeout: per-page OCR timeout in seconds, 0 means no timeout
+    :param cache_dir: the OCR cache, or None to not use a cache
+    :param on_page: if not None, called with (index into pages, (page_key, text)) in this process as soon as each page
+    is done, eg to checkpoint it
+    :return: (page_key, text) for each page, in the same order as pages. See ocr_image()
+    """
+    texts = [(None, "")] * len(pages)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(ocr_page, page, ocr, timeout, cache_dir): i for i, page in enumerate(pages)}
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            texts[i] = future.result()
+            if on_page is not None:
+                on_page(i, texts[i])
+            if verbose:
+                print("\tExtracted text from {} ({} out of {})".format(pages[i], done, len(pages)))
+    return texts
+
+
+def thread_safe_pool_context():
+    """
+    The way to start worker processes from a process that has other threads running. Forking copies whatever locks
+    those threads hold at that moment, eg the one on stdout, and a worker that then needs the lock hangs forever.
+    Spawned workers start a fresh interpreter instead, so anything sent to them has to be importable, and they see
+    the environment (eg REPORT_ENVIRONMENT_VARIABLE) as it is when the pool starts them
+    :return: a multiprocessing context for ProcessPoolExecutor(mp_context=...)
+    """
+    return multiprocessing.get_context("spawn")
+
+
+def put_until_cancelled(items: queue.Queue, item, cancel: threading.Event) -> bool:
+    """
+    Put item on the bounded queue items, waiting for space, unless cancel is set first
+    :param items:
+    :param item:
+    :param cancel:
+    :return: True if item was put on the queue, False if it was cancelled
+    """
+    while not cancel.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def rasterize_pages(pages: list, pages_per_read: int = 1):
+    """
+    Generator that rasterizes the pages of ocr_pages_pipelined(). Runs of consecutive pages of the same pdf are
+    rasterized together with rasterize_pdf_pages(), so each pdf is only opened once per run
+    :param pages: as accepted by ocr_page()
+    :param pages_per_read: see rasterize_pdf_pages()
+    :return: yields (index into pages, image, description). Image files are yielded as their path, without opening them
+    """
+    i = 0
+    while i < len(pages):
+        if isinstance(pages[i], str):
+            yield i, pages[i], pages[i]
+            i += 1
+            continue
+        pdf_path, first_page, _ = pages[i]
+        end = i + 1
+        while (end < len(pages) and not isinstance(pages[end], str) and pages[end][0] == pdf_path
+               and pages[end][1] == first_page + end - i):
+            end += 1
+        for offset, (page_number, image) in enumerate(timed_iter(
+                rasterize_pdf_pages(pdf_path, first_page, first_page + end - i, pages_per_read=pages_per_read),
+                "rasterize", pdf_path)):
+            png_path = pages[i + offset][2]
+            if png_path is not None:
+                image.save(png_path)
+            # rasterize_pdf_pages() closes the image when the next one is requested
+            yield i + offset, image.copy(), "{}[{}]".format(pdf_path, page_number)
+        i = end
+
+
+def ocr_pages_pipelined(pages: list, workers: int, queue_size: int = None, verbose: bool = True, ocr=tesseract_ocr,
+                        timeout: float = 0, cache_dir: str = None, pages_per_read: int = 1,
+                        cancel: threading.Event = None, on_page=None) -> list:
+    """
+    Like ocr_pages_in_parallel(), but the pages are rasterized by a background thread while the workers OCR the pages
+    before them, instead of each worker rasterizing its own page. The rasterized pages wait in a queue of at most
+    queue_size images, and only as many pages as there are workers are sent to them at once, so when OCR is the
+    bottleneck the rasterizing blocks instead of filling up memory.
+    If anything goes wrong in either, or cancel is set, both stop, the pages that haven't started are cancelled, and
+    the error (or CancelledError) is raised once the running pages have finished
+    :param pages: the pages, as accepted by ocr_page()
+    :param workers: the number of worker processes
+    :param queue_size: how many rasterized pages can wait for a worker. Defaults to 2 * workers
+    :param verbose: if True, log progress to the console
+    :param ocr: the OCR callable, see tesseract_ocr(). Has to be defined at module level of an importable module, since
+    the workers are spawned (see thread_safe_pool_context())
+    :param timeout: per-page OCR timeout in seconds, 0 means no timeout
+    :param cache_dir: the OCR cache, or None to not use a cache
+    :param pages_per_read: see rasterize_pdf_pages()
+    :param cancel: set this from another thread to stop early
+    :param on_page: see ocr_pages_in_parallel()
+    :return: (page_key, text) for each page, in the same order as pages. See ocr_image()
+    """
+    cancel = cancel or threading.Event()
+    rasterized = queue.Queue(maxsize=queue_size or 2 * workers)
+    errors = []
+
+    def rasterize() -> None:
+        try:
+            for item in rasterize_pages(pages, pages_per_read=pages_per_read):
+                if not put_until_cancelled(rasterized, item, cancel):
+                    return
+        except BaseException as error:
+            errors.append(error)
+            cancel.set()
+        finally:
+            # Tell the OCR loop there are no more pages
+            put_until_cancelled(rasterized, None, cancel)
+
+    texts = [(None, "")] * len(pages)
+    in_flight = {}
+    finished = False
+    completed = 0
+    # The rasterizer thread is running while the workers are started
+    with ProcessPoolExecutor(max_workers=workers, mp_context=thread_safe_pool_context()) as executor:
+        rasterizer = threading.Thread(target=rasterize, daemon=True)
+        rasterizer.start()
+        try:
+            while not cancel.is_set() and not (finished and not in_flight):
+                if not finished and len(in_flight) < workers:
+                    # A worker is free, so take the next page, if it's ready
+                    try:
+                        item = rasterized.get(timeout=0.1)
+                    except queue.Empty:
+                        item = ()
+                    if item is None:
+                        finished = True
+                    elif item:
+                        i, image, description = item
+                        if isinstance(image, str):
+                            future = executor.submit(ocr_page, image, ocr, timeout, cache_dir)
+                        else:
+                            future = executor.submit(ocr_image, image, description, ocr, timeout, cache_dir)
+                        in_flight[future] = i
+                    done, _ = wait(in_flight, timeout=0)
+                else:
+                    done, _ = wait(in_flight, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = in_flight.pop(future)
+                    texts[i] = future.result()
+                    if on_page is not None:
+                        on_page(i, texts[i])
+                    completed += 1
+                    if verbose:
+                        print("\tExtracted text from {} ({} out of {})".format(pages[i], completed, len(pages)))
+        except BaseException:
+            cancel.set()
+            raise
+        finally:
+            if cancel.is_set():
+                for future in in_flight:
+                    future.cancel()
+            rasterizer.join()
+
+    if errors:
+        raise errors[0]
+    if cancel.is_set():
+        raise CancelledError("OCR was cancelled")
+    return texts
+
+
+def ocr_journal_path(text_file_path: str) -> str:
+    """
+    :param text_file_path: root/txts/__filename__.txt
+    :return: where the OCR journal of that txt file is kept, root/txts/__filename__.journal
+    """
+    return os.path.splitext(text_file_path)[0] + ".journal"
+
+
+def load_ocr_journal(journal_path: str, header: dict) -> dict:
+    """
+    Read back the pages that an interrupted run finished, see start_ocr_journal()
+    :param journal_path:
+    :param header: what the journal has to have been started with. If it's a different version of the pdf or was
+    OCR'd with different settings, none of its pages are used
+    :return: dict of (page number : (page_key, text))
+    """
+    pages = {}
+    if not os.path.exists(journal_path):
+        return pages
+    with open(journal_path, "r") as journal:
+        lines = journal.readlines()
+    try:
+        if not lines or json.loads(lines[0]) != header:
+            return pages
+    except ValueError:
+        return pages
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # The line that was being written when the run was stopped
+            continue
+        pages[entry["page"]] = (entry["key"], entry["text"])
+    return pages
+
+
+def start_ocr_journal(journal_path: str, header: dict, pages: dict = None) -> None:
+    """
+    Start the journal of a pdf, where each page is recorded as soon as it's OCR'd (see append_ocr_journal()), so that
+    a run that is stopped part-way through a pdf can be resumed from the pages it hadn't done yet. It's one json
+    object per line, starting with header
+    :param journal_path: see ocr_journal_path()
+    :param header: identifies the version of the pdf and the OCR settings, see load_ocr_journal()
+    :param pages: the pages that are already done, as returned by load_ocr_journal()
+    :rtype: None
+    """
+    with atomic_write(journal_path) as journal:
+        journal.write(json.dumps(header) + "\n")
+        for page_number, (page_key, text) in sorted((pages or {}).items()):
+            journal.write(json.dumps({"page": page_number, "key": page_key, "text": text}) + "\n")
+
+
+def append_ocr_journal(journal_path: str, page_number: int, result: tuple) -> None:
+    """
+    Record one finished page in the journal made by start_ocr_journal(). Pages that came back empty without a cache
+    key, eg because the OCR timed out, aren't recorded, so they get another chance when the run is resumed
+    :param journal_path:
+    :param page_number: counting from 0
+    :param result: (page_key, text), see ocr_image()
+    :rtype: None
+    """
+    page_key, text = result
+    if page_key is None and not text:
+        return
+    with open(journal_path, "a") as journal:
+        journal.write(json.dumps({"page": page_number, "key": page_key, "text": text}) + "\n")
+
+
+def pdfs_to_texts(root: str, verbose: bool = True, reuse: bool = True, workers: int = 1, ocr=tesseract_ocr,
+                  timeout: float = 0, stream: bool = False, keep_pngs: bool = True, pages_per_read: int = 1,
+                  cache_dir: str = None, cache_max_bytes: int = None, cache_max_age_days: float = None,
+                  text_layer: bool = True, pipeline: bool = False, queue_size: int = None,
+                  cancel: threading.Event = None, resume: bool = False, on_text=None) -> None:
     """
     Look in root/pdfs, convert the pdfs to images (saved to root/pngs)
     and then extract the text from the images (saved to root/txts)
+    Whether each page's text came from the text layer or from OCR is saved to root/txts/page_sources.json
     :param root:
     :param verbose: if True, log progress to the console
-    :param reuse: If False, recreate the image and txt file, even if those files already exist
+    :param reuse: If False, recreate the image and txt file, even if those files already exist.
+    Ignored if cache_dir is given, since the cache knows whether a pdf has changed
+    :param workers: if more than 1, the pages of all the pdfs are OCR'd by this many worker processes
+    :param ocr: the OCR callable, see tesseract_ocr()
+    :param timeout: per-page OCR timeout in seconds, 0 means no timeout
+    :param stream: If True, never rasterize a whole pdf at once. See get_text_from_pdf()
+    :param keep_pngs: If stream, whether to also save each page to root/pngs/
+    :param pages_per_read: If stream and workers is 1, or pipeline, how many pages are rasterized at once
+    :param cache_dir: If not None, the OCR cache to use, usually OCR_CACHE_DIR. Pdfs and pages are looked up by the
+    hash of their contents, so unchanged pages are never OCR'd twice, even if the pdf is renamed or in another root
+    :param cache_max_bytes: If not None, evict the least recently used pages until the cache is at most this big
+    :param cache_max_age_days: If not None, evict pages that haven't been used for this many days
+    :param text_layer: If True, use the text already embedded in each page where there is some (see
+    extract_text_layer()), and only OCR the scanned or image-only pages
+    :param pipeline: If True, rasterize the pages in a background thread while the workers OCR them, see
+    ocr_pages_pipelined(). This works with any number of workers
+    :param queue_size: If pipeline, how many rasterized pages can wait for a worker
+    :param cancel: If pipeline, set this from another thread to stop early with a CancelledError
+    :param resume: If True, start each unfinished pdf from the pages that the last run had already OCR'd before it
+    was stopped, instead of from the first page. See start_ocr_journal()
+    :param on_text: if not None, called with the path of each txt file as soon as it's complete, including the ones
+    that are reused, eg to count it while the other pdfs are still being OCR'd. With workers or pipeline, a pdf's txt
+    file is written as soon as its last page is done
     :return: None
     """
     pdf_paths = sorted(glob.glob(os.path.join(os.path.join(root, "pdfs"), "*.pdf")))
+    # Pages of every pdf that still need to be OCR'd, to be sent to the worker pool all at once
+    pending = {}
+    manifest = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        manifest = load_ocr_manifest(cache_dir)
+    settings = ocr_settings(ocr)
+    pdf_settings = dict(settings, text_layer=text_layer)
+    # With a cache, pngs left over from a previous run might be of an older version of the pdf
+    reuse_pngs = reuse and cache_dir is None
+
+    page_sources_path = os.path.join(root, "txts", "page_sources.json")
+    page_sources = {}
+    if os.path.exists(page_sources_path):
+        with open(page_sources_path, "r") as json_file:
+            page_sources = json.load(json_file)
+
+    def save_pdf_text(text_file_path: str, pdf_path: str, pdf_key: str, results: list, sources: list) -> None:
+        # Write the data to the appropriate text file
+        text = [page_text for _, page_text in results]
+        unchanged = False
+        if os.path.exists(text_file_path):
+            with open(text_file_path, "r") as text_file:
+                unchanged = text_file.read() == "".join(text)
+        if not unchanged:
+            with atomic_write(text_file_path) as text_file:
+                text_file.writelines(text)
+        page_sources[get_filename(pdf_path)] = sources
+        with atomic_write(page_sources_path) as json_file:
+            json.dump(page_sources, json_file, indent=2)
+        # The txt file is complete, so its pages don't need to be resumed anymore
+        if os.path.exists(ocr_journal_path(text_file_path)):
+            os.remove(ocr_journal_path(text_file_path))
+        # Pages that timed out aren't cached, so neither is their pdf
+        if cache_dir is not None and all(page_key is not None for page_key, _ in results):
+            record_cached_pdf(cache_dir, manifest, pdf_key, pdf_path, [page_key for page_key, _ in results],
+                              sources, settings)
+        if on_text is not None:
+            on_text(text_file_path)
 
     for i, pdf_path in enumerate(pdf_paths, 1):
+        if cancel is not None and cancel.is_set():
+            raise CancelledError("OCR of {} was cancelled".format(root))
         file_id = get_filename(pdf_path)
         text_file_path = os.path.join(os.path.join(root, "txts"), file_id + ".txt")
 
-        if not reuse or not os.path.exists(text_file_path):
-            # The user doesn't want to reuse the already-processed files, or those files don't exist
+        pdf_key = None
+        if cache_dir is not None:
+            pdf_key = pdf_cache_key(pdf_path, pdf_settings)
+            pdf_text = read_cached_pdf(cache_dir, manifest, pdf_key)
+            if pdf_text is not None:
+                if verbose:
+                    print("'{}' is in the OCR cache. ({} out of {})".format(pdf_path, i, len(pdf_paths)))
+                entry = manifest["pdfs"][pdf_key]
+                save_pdf_text(text_file_path, pdf_path, pdf_key, list(zip(entry["pages"], pdf_text)),
+                              entry.get("sources", ["ocr"] * len(pdf_text)))
+                continue
+        elif reuse and os.path.exists(text_file_path):
+            # already-processed files exist, and the user wants to use them
             if verbose:
-                print("Opening '{}' ({} out of {})".format(pdf_path, i, len(pdf_paths)))
+                print("'{}' Already exists. ({} out of {})".format(text_file_path, i, len(pdf_paths)))
+            if on_text is not None:
+                on_text(text_file_path)
+            continue
 
-            # Write the data to the appropriate text file
-            with open(text_file_path, "w+") as text_file:
-                text = get_text_from_pdf(root, pdf_path, verbose=verbose, reuse=reuse)
-                text_file.writelines(text)
+        # The user doesn't want to reuse the already-processed files, or those files don't exist
+        if verbose:
+            print("Opening '{}' ({} out of {})".format(pdf_path, i, len(pdf_paths)))
+
+        # Each page is recorded in a journal as soon as it's OCR'd, so an interrupted run can be resumed from there
+        journal_path = ocr_journal_path(text_file_path)
+        journal_header = {"pdf": file_sha256(pdf_path), "settings": pdf_settings}
+        journaled = load_ocr_journal(journal_path, journal_header) if resume else {}
+        start_ocr_journal(journal_path, journal_header, journaled)
+        if journaled and verbose:
+            print("\tResuming from the {} pages that were already done".format(len(journaled)))
+
+        layer_texts = None
+        if text_layer:
+            with stage("text_layer", pdf_path) as record:
+                layer_texts = extract_text_layer(pdf_path)
+                record["items"] = len(layer_texts or [])
+        if layer_texts is not None and any(text is not None for text in layer_texts):
+            # Only OCR the pages that don't have a text layer
+            results = []
+            for text in layer_texts:
+                page_key = None
+                if text is not None and cache_dir is not None:
+                    page_key = text_page_cache_key(text)
+                    write_cached_page(cache_dir, page_key, text)
+                results.append((page_key, text))
+            sources = ["text layer" if text is not None else "ocr" for text in layer_texts]
+            page_numbers = [page_number for page_number, text in enumerate(layer_texts) if text is None]
+            pages = get_pdf_pages(root, pdf_path, verbose=verbose, keep_pngs=keep_pngs, page_numbers=page_numbers)
+            if verbose:
+                print("\t{} of {} pages have a text layer".format(len(layer_texts) - len(pages), len(layer_texts)))
+        elif workers > 1 or pipeline or journaled:
+            # Stream when resuming, so the pages that are already done aren't rasterized again
+            pages = get_pdf_pages(root, pdf_path, verbose=verbose, reuse=reuse_pngs,
+                                  stream=stream or pipeline or bool(journaled), keep_pngs=keep_pngs)
+            page_numbers = list(range(len(pages)))
+            results = [None] * len(pages)
+            sources = ["ocr"] * len(pages)
         else:
-            # already-processed files exist, and the user wants to use them
+            results = []
+            for page_number, result in enumerate(ocr_pdf(root, pdf_path, verbose=verbose, reuse=reuse_pngs, ocr=ocr,
+                                                         timeout=timeout, stream=stream, keep_pngs=keep_pngs,
+                                                         pages_per_read=pages_per_read, cache_dir=cache_dir)):
+                append_ocr_journal(journal_path, page_number, result)
+                results.append(result)
+            save_pdf_text(text_file_path, pdf_path, pdf_key, results, ["ocr"] * len(results))
+            continue
+
+        # Put back the pages that the last run already did, and only OCR the rest
+        for page_number, result in journaled.items():
+            results[page_number] = result
+        pages = [page for page_number, page in zip(page_numbers, pages) if page_number not in journaled]
+        page_numbers = [page_number for page_number in page_numbers if page_number not in journaled]
+
+        if (workers > 1 or pipeline) and pages:
+            pending[text_file_path] = (pdf_path, pdf_key, results, sources, list(zip(page_numbers, pages)))
+            continue
+        for page_number, page in zip(page_numbers, pages):
             if verbose:
-                print("'{}' Already exists. ({} out of {})".format(text_file_path, i, len(pdf_paths)))
+                print("\tExtracting text from page {} of {}".format(page_number + 1, pdf_path))
+            results[page_number] = ocr_page(page, ocr=ocr, timeout=timeout, cache_dir=cache_dir)
+            append_ocr_journal(journal_path, page_number, results[page_number])
+        save_pdf_text(text_file_path, pdf_path, pdf_key, results, sources)
+
+    if pending:
+        pages = [page for _, _, _, _, pdf_pages in pending.values() for _, page in pdf_pages]
+        # The txt file and page number of each page, so it can be recorded as soon as a worker finishes it
+        pending_pages = [(text_file_path, page_number)
+                         for text_file_path, (_, _, _, _, pdf_pages) in pending.items() for page_number, _ in pdf_pages]
+        remaining = {text_file_path: len(pdf_pages) for text_file_path, (_, _, _, _, pdf_pages) in pending.items()}
+
+        def page_done(i: int, result: tuple) -> None:
+            text_file_path, page_number = pending_pages[i]
+            append_ocr_journal(ocr_journal_path(text_file_path), page_number, result)
+            pdf_path, pdf_key, results, sources, _ = pending[text_file_path]
+            results[page_number] = result
+            remaining[text_file_path] -= 1
+            if remaining[text_file_path] == 0:
+                # The pdf is done, so its txt file can be used while the other pdfs are still being OCR'd
+                save_pdf_text(text_file_path, pdf_path, pdf_key, results, sources)
+
+        if verbose:
+            print("Extracting text from {} pages with {} workers".format(len(pages), workers))
+        if pipeline:
+            ocr_pages_pipelined(pages, workers, queue_size=queue_size, verbose=verbose, ocr=ocr, timeout=timeout,
+                                cache_dir=cache_dir, pages_per_read=pages_per_read, cancel=cancel, on_page=page_done)
+        else:
+            ocr_pages_in_parallel(pages, workers, verbose=verbose, ocr=ocr, timeout=timeout, cache_dir=cache_dir,
+                                  on_page=page_done)
+
+    with atomic_write(page_sources_path) as json_file:
+        json.dump(page_sources, json_file, indent=2)
 
+    if cache_dir is not None:
+        if cache_max_bytes is not None or cache_max_age_days is not None:
+            evict_ocr_cache(cache_dir, manifest, max_bytes=cache_max_bytes, max_age_days=cache_max_age_days,
+                            verbose=verbose)
+        save_ocr_manifest(cache_dir, manifest)
 
-def texts_to_jsons(root: str, verbose: bool = True) -> None:
+
+def normalise_text(text: str) -> str:
     """
-    Look in root/txts/ and convert the raw text into json files with (word : frequency) pairs, saved to root/summaries
-    :param root:
-    :param stopwords_path: a path to a textfile, newline-deliminated list of words to exclude from the json file.
-    :param verbose: if True, log progress to the console
-    :rtype: None
+    Collapse whitespace and meaningless punctuation in text down to single spaces, and convert it to lowercase
+    :param text:
+    :return:
     """
+    # regex replace all whitespace with a single space
+    text = re.sub(re.compile(r"\s"), " ", text)
+    # Remove meaningless punctuation
+    text = re.sub(re.compile(r"[.,;:\"@|]+"), " ", text)
+    # squash all sequential spaces to just be one space
+    text = re.sub(re.compile("[ ]+"), " ", text)
+    # convert the text to lowercase
+    return text.lower()
 
-    txt_files = sorted(glob.glob(os.path.join(root, "txts", "*.txt")))
+
+def tokenize_file(txt_file: str, chunk_size: int = TOKENIZE_CHUNK_SIZE):
+    """
+    Generator over the words of txt_file, reading it chunk_size characters at a time so memory use doesn't depend on
+    the size of the file. Gives exactly the same words as normalise_text(text).split(" "), including the empty words
+    at the start or end when the text starts or ends with whitespace or punctuation
+    :param txt_file:
+    :param chunk_size:
+    :return: yields each word, in lowercase
+    """
+    at_start = True
+    # The end of the previous chunk, which might be the start of a word that continues into the next chunk
+    carry = ""
+    with open(txt_file, "r") as txt:
+        for chunk in iter(lambda: txt.read(chunk_size), ""):
+            words = SEPARATORS.split(carry + chunk)
+            if words[0] == "" and carry == "" and not at_start:
+                # The previous chunk ended with separators, and so does the start of this one
+                words = words[1:]
+            if not words:
+                continue
+            at_start = False
+            carry = words.pop()
+            for word in words:
+                yield word.lower()
+    yield carry.lower()
+
+
+def load_stopwords(root: str) -> set:
+    """
+    Read the stopwords for root, which are kept in the first directory of root. The file is created from nltk's
+    english stopwords if it doesn't exist yet
+    :param root:
+    :return:
+    """
     stopwords_path = os.path.join(root.split(os.sep)[0], "stopwords.txt")
 
     if not os.path.exists(stopwords_path):
         # If the stopwords file doesn't exist, create it
-        with open(stopwords_path, "w+") as stopwords_txt:
+        from nltk import corpus
+        with atomic_write(stopwords_path) as stopwords_txt:
             stopwords_txt.writelines([word + "\n" for word in corpus.stopwords.words('english')])
 
     # Read in the stopwords from the stopwords file
     with open(stopwords_path, "r") as stopwords_txt:
-        stopwords = set([word.strip() for word in stopwords_txt.readlines()])
+        return set([word.strip() for word in stopwords_txt.readlines()])
 
-    for i, txt_file in enumerate(txt_files, 1):
+
+def count_text_file(txt_file: str, stopwords: set, count_mode: str = "substring") -> dict:
+    """
+    Count the n-grams in txt_file, see count_ngrams()
+    :param txt_file:
+    :param stopwords: tokens to exclude
+    :param count_mode: one of COUNT_MODES
+    :return: dict of (token : frequency) pairs, unsorted
+    """
+    # for debugging in case you find funky things coming through the filters:
+    # split_text = list(tokenize_file(txt_file))
+    # for j, word in enumerate(split_text):
+    #     if len(word) <= 3 and j + 5 < len(split_text) and j > 5 and word not in stopwords:
+    #         context = " ".join(split_text[j - 5:j + 5])
+    #         print(f"{get_filename(txt_file):<25}{word:<10}{context}")
+
+    # The count includes the time spent tokenizing, which is also recorded on its own for each pass over the words
+    with stage("count", txt_file, count_mode=count_mode) as record:
+        frequencies = count_ngrams(lambda: timed_iter(tokenize_file(txt_file), "tokenize", txt_file), stopwords,
+                                   mode=count_mode)
+        record["items"] = len(frequencies)
+    return frequencies
+
+
+def add_frequencies(totals: dict, frequencies: dict, sign: int = 1) -> None:
+    """
+    Add (or with sign=-1, subtract) frequencies to totals in place. Tokens that drop to 0 are removed from totals
+    :param totals:
+    :param frequencies:
+    :param sign: 1 or -1
+    :rtype: None
+    """
+    for key, value in frequencies.items():
+        total = totals.get(key, 0) + sign * value
+        if total == 0:
+            totals.pop(key, None)
+        else:
+            totals[key] = total
+
+
+def document_term_matrix(json_paths: list) -> tuple:
+    """
+    Load the (word : frequency) json files into a sparse matrix, with one row per json file and one column per token
+    :param json_paths:
+    :return: (vocabulary, matrix). vocabulary is every token, sorted alphabetically, so that column i of matrix is
+    the frequency of vocabulary[i]
+    """
+    import numpy as np
+    from scipy import sparse
+    documents = [load_frequencies(json_path) for json_path in json_paths]
+
+    vocabulary = sorted(set().union(*documents))
+    index = {token: i for i, token in enumerate(vocabulary)}
+    indptr, indices, data = [0], [], []
+    for document in documents:
+        indices.extend(index[token] for token in document)
+        data.extend(document.values())
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((np.array(data, dtype=np.int64), np.array(indices, dtype=np.int64), indptr),
+                               shape=(len(documents), len(vocabulary)))
+    return vocabulary, matrix
+
+
+def top_indices(values: np.ndarray, top_k: int = None) -> np.ndarray:
+    """
+    The indices of values, sorted by value descending. Ties keep their original order, so when values is indexed by
+    an alphabetical vocabulary this is the same order as sorted_dictionary()
+    :param values:
+    :param top_k: if not None, only return the indices of the top_k largest values
+    :return:
+    """
+    import numpy as np
+    if top_k is None or top_k >= len(values):
+        return np.argsort(-values, kind="stable")
+    if top_k <= 0:
+        return np.array([], dtype=np.int64)
+    # Anything tied with the kth largest value might make the cut, depending on where it is alphabetically
+    threshold = np.partition(-values, top_k - 1)[top_k - 1]
+    candidates = np.flatnonzero(-values <= threshold)
+    return candidates[np.argsort(-values[candidates], kind="stable")][:top_k]
+
+
+def write_penalties(root: str, json_paths: list, verbose: bool = True, top_k: int = None,
+                    compact: bool = False) -> None:
+    """
+    Go through every topic json file, and calculate it's difference from the overall frequencies.
+    Saved to root/summaries/penalties
+    The penalty of a token is twice its frequency in the topic, minus its frequency in all topics together. That's
+    once because it's already part of the total, and again so that more frequent words get more weight
+    :param root:
+    :param json_paths: the json files of the topics
+    :param verbose: if True, log progress to the console
+    :param top_k: if not None, only save the top_k highest penalties of each topic
+    :param compact: if True, leave out all the whitespace in the json files
+    :rtype: None
+    """
+    import numpy as np
+    with stage("penalties", root, items=len(json_paths)):
+        vocabulary, matrix = document_term_matrix(json_paths)
+        totals = np.asarray(matrix.sum(axis=0)).ravel()
+        # Do a block of topics at a time, so the dense penalties stay around PENALTY_BLOCK_SIZE values
+        block_size = max(1, PENALTY_BLOCK_SIZE // max(1, len(vocabulary)))
+
+        for start in range(0, len(json_paths), block_size):
+            penalties = 2 * matrix[start:start + block_size].toarray() - totals
+            block_paths = json_paths[start:start + block_size]
+            for i, (json_path, penalty) in enumerate(zip(block_paths, penalties), start + 1):
+                if verbose:
+                    print("Creating delta for {} ({} out of {})".format(json_path, i, len(json_paths)))
+                order = top_indices(penalty, top_k)
+                offset = dict(zip([vocabulary[i] for i in order], penalty[order].tolist()))
+
+                delta_path = os.path.join(root, "summaries", "penalties", get_filename(json_path) + ".json")
+                with atomic_write(delta_path) as json_file:
+                    if compact:
+                        json.dump(offset, json_file, separators=(",", ":"))
+                    else:
+                        json.dump(offset, json_file, indent=2)
+
+
+def texts_to_jsons(root: str, verbose: bool = True, count_mode: str = "substring", incremental: bool = False,
+                   penalty_top_k: int = None, summary_top_k: int = None, compact: bool = False,
+                   sidecar: bool = False, ready=None) -> None:
+    """
+    Look in root/txts/ and convert the raw text into json files with (word : frequency) pairs, saved to root/summaries
+    :param root:
+    :param verbose: if True, log progress to the console
+    :param count_mode: how n-grams are counted, one of COUNT_MODES. See count_ngrams()
+    :param incremental: if True, only count the txt files that were added or changed since the last run, and update
+    all_topics.json by adding and removing just their counts. The output is the same as a full rebuild.
+    What was counted last time is kept in root/summaries/counts_state.json
+    :param penalty_top_k: if not None, only save the top penalty_top_k tokens of each topic to root/summaries/penalties
+    :param summary_top_k: if not None, only save the top summary_top_k tokens to the json files and all_topics.json.
+    This turns on sidecar, since the penalties need the full vocabulary
+    :param compact: if True, leave out all the whitespace in the json files
+    :param sidecar: if True, save the full vocabulary of every json file to a binary .vocab file next to it
+    :param ready: if not None, an iterator over txt files of root/txts as they are written, eg by pdfs_to_texts() in
+    another thread. Each one is counted as soon as it arrives, and the rest of root/txts once ready is exhausted
+    :rtype: None
+    """
+    sidecar = sidecar or summary_top_k is not None
+
+    stopwords = load_stopwords(root)
+    jsons_directory = os.path.join(root, "summaries", "jsons")
+    all_topics_path = os.path.join(root, "summaries", "all_topics.json")
+    state_path = os.path.join(root, "summaries", "counts_state.json")
+
+    # Anything that changes the outputs for an unchanged txt file
+    settings = {
+        "count_mode": count_mode,
+        "penalty_top_k": penalty_top_k,
+        "summary_top_k": summary_top_k,
+        "compact": compact,
+        "sidecar": sidecar,
+        "stopwords": hashlib.sha256("\n".join(sorted(stopwords)).encode()).hexdigest(),
+    }
+
+    state = None
+    if incremental and os.path.exists(state_path) and os.path.exists(all_topics_path):
+        with open(state_path, "r") as json_file:
+            state = json.load(json_file)
+        missing = [name for name in state["documents"]
+                   if not os.path.exists(os.path.join(jsons_directory, name + ".json"))]
+        if state["settings"] != settings or missing:
+            if verbose:
+                print("Counting settings or json files have changed, recounting everything in {}".format(root))
+            state = None
+
+    all_topics = {} if state is None else load_frequencies(all_topics_path)
+    # The fingerprint of each txt file when it was last counted: in the last run, or in this one
+    previous = {} if state is None else state["documents"]
+    counted = {}
+
+    def count_changed(txt_file: str, fingerprint: str, progress: str) -> None:
+        name = get_filename(txt_file)
+        if not counted and os.path.exists(state_path):
+            # The old counts of a changed file are taken out of all_topics.json using its old json file, so if this
+            # run is interrupted after rewriting some of them, the next incremental run has to recount everything
+            os.remove(state_path)
         if verbose:
-            print("Converting {} to json ({} out of {})".format(txt_file, i, len(txt_files)))
-
-        with open(txt_file, "r") as txt:
-            text = "\n".join(txt.readlines())
-
-        # regex replace all whitespace with a single space
-        text = re.sub(re.compile(r"\s"), " ", text)
-        # Remove meaningless punctuation
-        text = re.sub(re.compile(r"[.,;:\"@|]+"), " ", text)
-        # squash all sequential spaces to just be one space
-        text = re.sub(re.compile("[ ]+"), " ", text)
-        # convert the text to lowercase
-        text = text.lower()
-
-        tokens = set()
-        split_text = [word.strip() for word in text.split(" ")]
-
-        for j, word in enumerate(split_text):
-            if not word.isspace() and len(word) > 2:
-                tokens.add(word)
-
-            # for debugging in case you find funky things coming through the filters:
-            # if len(word) <= 3 and j + 5 < len(split_text) and j > 5 and word not in stopwords:
-            #     context = " ".join(split_text[j - 5:j + 5])
-            #     print(f"{get_filename(txt_file):<25}{word:<10}{context}")
-            if j + 1 < len(split_text):
-                tokens.add(word + " " + split_text[j + 1])
-            if j + 2 < len(split_text):
-                tokens.add(word + " " + split_text[j + 1] + " " + split_text[j + 2])
-        # Exclude the stopwords
-        tokens -= stopwords
-
-        def fancy_count(needle: str, haystack: str) -> int:
-            # TODO create a better counting function, that'll do some fuzzy matching with capitals, bad OCR etc
-            return haystack.count(needle)
+            print("Converting {} to json{}".format(txt_file, progress))
+        json_path = os.path.join(jsons_directory, name + ".json")
 
         # Get the frequency of each token
-        frequencies = [fancy_count(word, text) for word in tokens]
+        frequencies = count_text_file(txt_file, stopwords, count_mode=count_mode)
 
-        # gather the words and frequencies into a dict, then sort it
-        json_dict = sorted_dictionary({word: freq for word, freq in zip(list(tokens), frequencies)})
+        with stage("aggregate", txt_file, items=len(frequencies)):
+            if name in counted or name in previous:
+                # Take the old counts of this file out of the totals
+                add_frequencies(all_topics, load_frequencies(json_path), sign=-1)
+            add_frequencies(all_topics, frequencies)
 
         # write as json file
-        json_path = os.path.join(root, "summaries", "jsons", get_filename(txt_file) + ".json")
-        with open(json_path, "w") as json_file:
-            json.dump(json_dict, json_file, indent=2)
+        write_summary(json_path, frequencies, top_k=summary_top_k, compact=compact, sidecar=sidecar)
+        counted[name] = fingerprint
 
-    json_paths = sorted(glob.glob(os.path.join(root, "summaries", "jsons", "*.json")))
-    all_topics = {}
-    for json_path in json_paths:
-        with open(json_path, "r") as json_file:
-            data: dict = json.load(json_file)
-            for key, value in data.items():
-                if key in all_topics:
-                    all_topics[key] += value
-                else:
-                    all_topics[key] = value
-    # sort the words by their frequency, descending
-    all_topics = sorted_dictionary(all_topics)
-    # write out the cumulative totals of all the topics to JSON
-    all_topics_path = os.path.join(root, "summaries", "all_topics.json")
-    with open(all_topics_path, "w") as json_file:
-        json.dump(all_topics, json_file, indent=2)
+    for txt_file in ready or ():
+        fingerprint = file_sha256(txt_file)
+        name = get_filename(txt_file)
+        if counted.get(name, previous.get(name)) != fingerprint:
+            count_changed(txt_file, fingerprint, "")
 
-    # Now go through every topic json file, and calculate it's difference from the overall frequencies
-    json_paths = sorted(glob.glob(os.path.join(root, "summaries", "jsons", "*.json")))
-    for i, json_path in enumerate(json_paths, 1):
+    txt_files = sorted(glob.glob(os.path.join(root, "txts", "*.txt")))
+    fingerprints = {get_filename(txt_file): file_sha256(txt_file) for txt_file in txt_files}
+    changed = [txt_file for txt_file in txt_files
+               if counted.get(get_filename(txt_file), previous.get(get_filename(txt_file)))
+               != fingerprints[get_filename(txt_file)]]
+    if state is None:
+        # Count everything from scratch, and drop the json files of txt files that don't exist anymore
+        removed = [get_filename(json_path) for json_path in glob.glob(os.path.join(jsons_directory, "*.json"))
+                   if get_filename(json_path) not in fingerprints]
+    else:
+        removed = [name for name in state["documents"] if name not in fingerprints]
+
+    for i, txt_file in enumerate(changed, 1):
+        count_changed(txt_file, fingerprints[get_filename(txt_file)], " ({} out of {})".format(i, len(changed)))
+
+    if removed and os.path.exists(state_path):
+        os.remove(state_path)
+    for name in removed:
         if verbose:
-            print("Creating delta for {} ({} out of {})".format(json_path, i, len(json_paths)))
+            print("Removing {}, since its txt file is gone".format(name))
+        json_path = os.path.join(jsons_directory, name + ".json")
+        if state is not None:
+            add_frequencies(all_topics, load_frequencies(json_path), sign=-1)
+        for path in [json_path, vocabulary_sidecar_path(json_path),
+                     os.path.join(root, "summaries", "penalties", name + ".json")]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    if state is not None and not counted and not removed:
+        if verbose:
+            print("Nothing has changed in {}".format(root))
+        return
 
-        offset = {key: -value for key, value in all_topics.items()}
-        with open(json_path, "r") as json_file:
-            delta: dict = json.load(json_file)
+    # write out the cumulative totals of all the topics to JSON, sorted by frequency
+    with stage("aggregate", all_topics_path, items=len(all_topics)):
+        write_summary(all_topics_path, all_topics, top_k=summary_top_k, compact=compact, sidecar=sidecar)
 
-        for key, value in delta.items():
-            if key in offset:
-                # Add the value twice, once becuase it's already part of all_topics,
-                # and again so that more frequent words get more weight
-                offset[key] += 2 * value
-            else:
-                offset[key] = value
+    # Every penalty depends on all_topics, so they all have to be redone when anything changes
+    json_paths = [os.path.join(jsons_directory, name + ".json") for name in sorted(fingerprints)]
+    write_penalties(root, json_paths, verbose=verbose, top_k=penalty_top_k, compact=compact)
 
-        delta_path = os.path.join(root, "summaries", "penalties", get_filename(json_path) + ".json")
-        with open(delta_path, "w") as json_file:
-            json.dump(sorted_dictionary(offset), json_file, indent=2)
+    with atomic_write(state_path) as json_file:
+        json.dump({"settings": settings, "documents": fingerprints}, json_file, indent=2)
 
     # TODO create a bar graph of how often the words in this topic DON'T appear in the other topics
 
 
-def json_to_bar_chart(json_path: str, num_words: int = 50, verbose: bool = True) -> None:
+def json_to_bar_chart(json_path: str, num_words: int = 50, verbose: bool = True, dpi: int = CHART_DPI) -> None:
     """
     Graph and save a bar chart with the frequencies of the words in json_path
     :param root:
     :param json_path: path to json file containing the words and their frequencies
     :param num_words: the maximum number of words to graph
     :param verbose: if True, log progress to the console
+    :param dpi: resolution of the saved chart
     :rtype: None, bar graphs are saved in corpus/summaries/bars/
     """
+    import numpy as np
+    plt = import_pyplot()
     with open(json_path, "r") as jsonfile:
         data: dict = json.load(jsonfile)
     unique_words, frequencies = list(data.keys()), list(data.values())
@@ -238,45 +2016,116 @@ def json_to_bar_chart(json_path: str, num_words: int = 50, verbose: bool = True)
     size_ratio = 0.1
     height = 2 * size_ratio * num_words
     width = 1 * size_ratio * num_words
-    plt.figure(figsize=(width, height), dpi=400)
-    plt.barh(index, frequencies[:num_words])
-    plt.ylabel('Word', fontsize=10)
-    plt.xlabel('Frequency', fontsize=10)
-    plt.yticks(index, unique_words[:num_words], fontsize=7)
-    plt.gca().invert_yaxis()
-    plt.title('Frequency of words in ' + get_filename(json_path))
-    plt.tight_layout()
+    fig, ax = plt.subplots(figsize=(width, height), dpi=dpi)
+    ax.barh(index, frequencies[:num_words])
+    ax.set_ylabel('Word', fontsize=10)
+    ax.set_xlabel('Frequency', fontsize=10)
+    ax.set_yticks(index)
+    ax.set_yticklabels(unique_words[:num_words], fontsize=7)
+    ax.invert_yaxis()
+    ax.set_title('Frequency of words in ' + get_filename(json_path))
+    fig.tight_layout()
 
     # TODO: often fails here: Process finished with exit code 139 (interrupted by signal 11: SIGSEGV)
-    path = json_path.split(os.sep)
-
-    bar_directory = os.path.join(*path[:-2], "bars")
+    # Saved next to the json file's directory, eg summaries/jsons/a.json goes to summaries/bars/
+    bar_directory = os.path.join(os.path.dirname(os.path.dirname(json_path)), "bars")
     os.makedirs(bar_directory, exist_ok=True)
     bar_path = os.path.join(bar_directory, get_filename(json_path) + "_bar_chart.png")
     if verbose:
         print("Saving bar chart of {}".format(json_path))
-    plt.savefig(bar_path)
+    with atomic_write(bar_path, "wb") as png_file:
+        fig.savefig(png_file, format="png")
+    # Figures are never freed otherwise, so memory would grow with every chart
+    plt.close(fig)
+
+
+def load_topic_index(root: str) -> dict:
+    """
+    Load every topic in root/topics/summaries/jsons into one index, which can be shared by all the memos
+    :param root:
+    :return: dict with "topics", the topic names, "index", a (token : column) dict, "totals", the frequency of each
+    token over all the topics, and "matrix", a sparse boolean matrix with a row for each topic that is True in the
+    column of every token in that topic
+    """
+    import numpy as np
+    json_topic_paths = sorted(glob.glob(os.path.join(root, "topics", "summaries", "jsons", "*.json")))
+    vocabulary, matrix = document_term_matrix(json_topic_paths)
+    return {
+        "topics": [get_filename(topic_path) for topic_path in json_topic_paths],
+        "index": {token: i for i, token in enumerate(vocabulary)},
+        "totals": np.asarray(matrix.sum(axis=0)).ravel(),
+        "matrix": matrix.astype(bool),
+    }
+
 
-    # plt.show()
+def score_memos(root: str, memo_json_paths: list, topic_index: dict = None, fuzzy_distance: int = 0) -> dict:
+    """
+    Score every memo against every topic at once. A memo's score for a topic is the total frequency of the memo's
+    words that also appear in the topic
+    :param root:
+    :param memo_json_paths: the json files of the memos
+    :param topic_index: see load_topic_index(). Loaded from root if None
+    :param fuzzy_distance: if more than 0, memo words that were mangled by OCR are matched to topic words up to this
+    edit distance away, see build_fuzzy_index()
+    :return: dict of (memo name : dict of (topic name : score))
+    """
+    import numpy as np
+    from scipy import sparse
+    if topic_index is None:
+        topic_index = load_topic_index(root)
+    index = topic_index["index"]
+    fuzzy_index = None
+    if fuzzy_distance > 0:
+        fuzzy_index = build_fuzzy_index(dict(zip(index, topic_index["totals"].tolist())), max_distance=fuzzy_distance)
+
+    # Words that aren't in any topic can't add to any score, so they're left out of the memo matrix
+    indptr, indices, data = [0], [], []
+    for memo_json_path in memo_json_paths:
+        memo = load_frequencies(memo_json_path)
+        if fuzzy_index is not None:
+            memo = canonicalise_frequencies(memo, fuzzy_index)
+        for word, freq in memo.items():
+            if word in index:
+                indices.append(index[word])
+                data.append(freq)
+        indptr.append(len(indices))
+    memos = sparse.csr_matrix((np.array(data, dtype=np.int64), np.array(indices, dtype=np.int64), indptr),
+                              shape=(len(memo_json_paths), len(index)))
+
+    scores = (memos @ topic_index["matrix"].T.astype(np.int64)).toarray()
+    return {get_filename(memo_json_path): dict(zip(topic_index["topics"], memo_scores.tolist()))
+            for memo_json_path, memo_scores in zip(memo_json_paths, scores)}
+
+
+def write_topic_scores(root: str, topic_scores: dict) -> None:
+    """
+    Save the output of score_memos() to root/corpus/summaries/topic_scores.json
+    :param root:
+    :param topic_scores:
+    :rtype: None
+    """
+    with atomic_write(os.path.join(root, "corpus", "summaries", "topic_scores.json")) as json_file:
+        json.dump(topic_scores, json_file, indent=2)
 
 
-def json_to_pie_chart(root: str, memo_json_path: str, verbose: bool = True) -> None:
+def json_to_pie_chart(root: str, memo_json_path: str, verbose: bool = True, topic_scores: dict = None,
+                      dpi: int = CHART_DPI) -> None:
     """
     Graph and save a single pie chart, that shows the composition of the pdf represented by memo_json_path.
     The different categories represented by the wedges of the pie are the different json files found in topics/summaries
     :param root:
     :param memo_json_path:
     :param verbose:
+    :param topic_scores: the output of score_memos() for every memo. If None, this memo is scored on its own, but
+    scoring all the memos at once is much faster
+    :param dpi: resolution of the saved chart
     :rtype: None
     """
+    import seaborn as sns
+    plt = import_pyplot()
     if verbose:
         print("Graphing pie chart of {}".format(memo_json_path))
 
-    with open(memo_json_path, "r") as jsonfile:
-        data: dict = json.load(jsonfile)
-    memo_words, memo_freqs = list(data.keys()), list(data.values())
-    topic_scores = {}
-
     json_topic_paths = sorted(glob.glob(os.path.join(root, "topics", "summaries", "jsons", "*.json")))
     # test_files/corpus/summaries/jsons/test_1.json
     if len(json_topic_paths) == 0:
@@ -284,20 +2133,13 @@ def json_to_pie_chart(root: str, memo_json_path: str, verbose: bool = True) -> N
             os.path.join(root, "topics", "summaries", "jsons", "*.json")))
         return
 
-    for topic_path in json_topic_paths:
-        with open(topic_path, "r") as jsonfile:
-            data: dict = json.load(jsonfile)
+    if topic_scores is None:
+        topic_scores = score_memos(root, [memo_json_path])
+    topic_scores = topic_scores[get_filename(memo_json_path)]
 
-        topic_name = get_filename(topic_path)
-        topic_words = list(data.keys())
-        topic_scores[topic_name] = 0
-        for memo_word, memo_freq in zip(memo_words, memo_freqs):
-            if memo_word in topic_words:
-                topic_scores[topic_name] += memo_freq
+    sns.set_palette(sns.color_palette("BrBG", len(topic_scores)))
 
-    sns.set_palette(sns.color_palette("BrBG", len(json_topic_paths)))
-
-    fig, ax = plt.subplots(figsize=(10, 5), dpi=400, subplot_kw=dict(aspect="equal"))
+    fig, ax = plt.subplots(figsize=(10, 5), dpi=dpi, subplot_kw=dict(aspect="equal"))
 
     topic_scores = sorted([(topic, score) for topic, score in list(topic_scores.items())], key=lambda x: x[1])
     labels = [item[0] for item in topic_scores]
@@ -315,23 +2157,329 @@ def json_to_pie_chart(root: str, memo_json_path: str, verbose: bool = True) -> N
     ax.set_title("Composition of " + get_filename(memo_json_path).title())
 
     pie_path = os.path.join(root, "corpus", "summaries", "pies", get_filename(memo_json_path) + "_pie_chart.png")
-    plt.tight_layout()
-    plt.savefig(pie_path)
+    fig.tight_layout()
+    with atomic_write(pie_path, "wb") as png_file:
+        fig.savefig(png_file, format="png")
+    plt.close(fig)
+
 
+def set_chart_theme() -> None:
+    """
+    Use the seaborn theme for every chart drawn after this in this process. It's the initializer of the processes
+    that render charts, since spawned processes don't inherit the theme of the process that started them
+    :rtype: None
+    """
+    import seaborn as sns
+    sns.set()
 
-def split_into_questions(root: str, text_file_path: str):
-    lines = []
+
+def render_chart(chart: tuple) -> None:
+    """
+    Render one chart from render_charts(). This is a module level function so that it can be sent to worker processes
+    :param chart: (function, args, kwargs) to call
+    :rtype: None
+    """
+    function, args, kwargs = chart
+    # The json file being graphed is the first argument of json_to_bar_chart() and the second of json_to_pie_chart()
+    json_path = args[0] if function is json_to_bar_chart else args[1]
+    with stage("render", json_path, chart=function.__name__):
+        function(*args, **kwargs)
+
+
+def render_charts(root: str, bar_json_paths: list = (), pie_json_paths: list = (), num_words: int = 50,
+                  dpi: int = CHART_DPI, workers: int = 1, verbose: bool = True, topic_scores: dict = None) -> None:
+    """
+    Render a batch of bar charts and pie charts. Every figure is closed once it's saved, so memory doesn't grow with
+    the number of charts
+    :param root:
+    :param bar_json_paths: json files to graph with json_to_bar_chart()
+    :param pie_json_paths: memo json files to graph with json_to_pie_chart(). They are all scored at once
+    :param num_words: the maximum number of words in each bar chart
+    :param dpi: resolution of the saved charts
+    :param workers: if more than 1, render the charts in this many worker processes
+    :param verbose: if True, log progress to the console
+    :param topic_scores: the output of score_memos() for pie_json_paths, if it has already been calculated
+    :rtype: None
+    """
+    charts = [(json_to_bar_chart, (json_path, num_words, verbose, dpi), {}) for json_path in bar_json_paths]
+    if pie_json_paths:
+        if topic_scores is None:
+            topic_scores = score_memos(root, pie_json_paths)
+        for memo_json_path in pie_json_paths:
+            # Only send each worker the scores it needs
+            memo_scores = {get_filename(memo_json_path): topic_scores[get_filename(memo_json_path)]}
+            charts.append((json_to_pie_chart, (root, memo_json_path, verbose, memo_scores, dpi), {}))
+
+    if workers <= 1:
+        for chart in charts:
+            render_chart(chart)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_chart_theme) as executor:
+        for _ in executor.map(render_chart, charts):
+            pass
+
+
+def load_question_patterns(root: str) -> dict:
+    """
+    Read the question patterns for root, which are kept in regex.txt in the first directory of root, next to
+    stopwords.txt. Each line is name="pattern", with the pattern written like a python string. The file is created
+    from QUESTION_PATTERNS if it doesn't exist yet
+    :param root:
+    :return: dict of (name : compiled pattern), with at least the names in QUESTION_PATTERNS
+    """
+    regex_path = os.path.join(root.split(os.sep)[0], "regex.txt")
+
+    if not os.path.exists(regex_path):
+        # If the regex file doesn't exist, create it
+        with atomic_write(regex_path) as regex_txt:
+            regex_txt.writelines(["{}={}\n".format(name, json.dumps(pattern))
+                                  for name, pattern in QUESTION_PATTERNS.items()])
+
+    patterns = dict(QUESTION_PATTERNS)
+    with open(regex_path, "r") as regex_txt:
+        for line in regex_txt.readlines():
+            if "=" in line:
+                name, pattern = line.split("=", 1)
+                patterns[name.strip()] = ast.literal_eval(pattern.strip())
+    return {name: re.compile(pattern) for name, pattern in patterns.items()}
+
+
+def split_at_matches(text: str, pattern: re.Pattern) -> list:
+    """
+    Split text at the start of every match of pattern
+    :param text:
+    :param pattern:
+    :return: list of (label, text) pairs, starting with (None, the text before the first match). The label of each
+    match is the first group of pattern, or the first word of the match if pattern has no groups
+    """
+    matches = list(pattern.finditer(text))
+    pieces = [(None, text[:matches[0].start() if matches else len(text)])]
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        label = match.group(1) if pattern.groups else (match.group(0).split() or [""])[0]
+        pieces.append((" ".join(label.split()), text[match.start():len(text) if next_match is None
+                                                     else next_match.start()]))
+    return pieces
+
+
+def split_into_questions(root: str, text_file_path: str) -> list:
+    """
+    Split the text of a paper into its questions and subquestions, using the patterns in regex.txt (see
+    load_question_patterns()). Each question runs from the start of its match to the start of the next question,
+    and is split again at each of its subquestions. The text of a question before its first subquestion is kept
+    under the question's own label
+    :param root:
+    :param text_file_path:
+    :return: list of (label, text) pairs in the order they appear in the paper, eg ("Question 2 (b)", "(b) Explain...").
+    The text before the first question is labelled PREAMBLE_LABEL, and pieces that are just whitespace are left out
+    """
+    patterns = load_question_patterns(root)
     with open(text_file_path, "r") as text_file:
-        lines = text_file.readlines()
+        text = text_file.read()
 
-    pass
+    questions = []
+    for question, question_text in split_at_matches(text, patterns["regex_question"]):
+        if question is None:
+            questions.append((PREAMBLE_LABEL, question_text))
+            continue
+        for subquestion, subquestion_text in split_at_matches(question_text, patterns["regex_subquestion"]):
+            questions.append((question if subquestion is None else question + " " + subquestion, subquestion_text))
+    return [(label, question_text) for label, question_text in questions if question_text.strip()]
 
-    # self.text = self.text.replace('\n', ' ').replace('\r', '')
-    # self.text = re.sub(re.compile("_{3,}"), "\n", self.text)
-    # end_of_question_pattern = re.compile("\\?")
+
+def open_question_index(root: str) -> sqlite3.Connection:
+    """
+    Open the inverted index of the questions in root, kept in root/summaries/QUESTION_INDEX_NAME, and create its
+    tables if they don't exist yet. It has
+    "settings", what the index was made with, see index_questions(),
+    "papers", the fingerprint of the txt file each paper was indexed from,
+    "questions", every question of every paper, with its position in the paper, label and text, and
+    "postings", the frequency of each term in each question. It's keyed by term, so looking up a term only reads the
+    questions that have it
+    :param root:
+    :return: the connection, which the caller has to close
+    """
+    connection = sqlite3.connect(os.path.join(root, "summaries", QUESTION_INDEX_NAME))
+    # Postings are inserted all over the term order, so give sqlite a big cache to keep the pages it's changing in
+    connection.execute("PRAGMA cache_size = -{}".format(QUESTION_INDEX_CACHE_KIB))
+    connection.executescript("""
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS papers (paper TEXT PRIMARY KEY, fingerprint TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, paper TEXT NOT NULL, position INTEGER NOT NULL,
+                                              label TEXT NOT NULL, text TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS questions_by_paper ON questions (paper, position);
+        CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, question INTEGER NOT NULL, count INTEGER NOT NULL,
+                                             PRIMARY KEY (term, question)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS postings_by_question ON postings (question);
+    """)
+    return connection
+
+
+def remove_indexed_paper(connection: sqlite3.Connection, paper: str) -> None:
+    """
+    Take every question of paper out of the question index, see open_question_index()
+    :param connection:
+    :param paper: the name of the paper's txt file, without the extension
+    :rtype: None
+    """
+    connection.execute("DELETE FROM postings WHERE question IN (SELECT id FROM questions WHERE paper = ?)", (paper,))
+    connection.execute("DELETE FROM questions WHERE paper = ?", (paper,))
+    connection.execute("DELETE FROM papers WHERE paper = ?", (paper,))
 
 
-def create_test_topics(root, topic_ids, total_unique_words=10, total_words=50, graph=True):
+def index_questions(root: str, verbose: bool = True, count_mode: str = "substring", incremental: bool = False) -> None:
+    """
+    Look in root/txts/, split every paper into questions (see split_into_questions()) and save the frequency of every
+    n-gram in each question to the inverted index in root/summaries, see open_question_index()
+    :param root:
+    :param verbose: if True, log progress to the console
+    :param count_mode: how n-grams are counted, one of COUNT_MODES. See count_ngrams()
+    :param incremental: if True, only index the txt files that were added or changed since the last run, and drop the
+    papers whose txt file is gone. The index is the same as a full rebuild
+    :rtype: None
+    """
+    txt_files = sorted(glob.glob(os.path.join(root, "txts", "*.txt")))
+    stopwords = load_stopwords(root)
+
+    # Anything that changes the index for an unchanged txt file
+    settings = json.dumps({
+        "count_mode": count_mode,
+        "stopwords": hashlib.sha256("\n".join(sorted(stopwords)).encode()).hexdigest(),
+        "patterns": {name: pattern.pattern for name, pattern in load_question_patterns(root).items()},
+    }, sort_keys=True)
+    fingerprints = {get_filename(txt_file): file_sha256(txt_file) for txt_file in txt_files}
+
+    connection = open_question_index(root)
+    try:
+        # The whole run is one transaction, so an interrupted run leaves the index as it was. Committing each paper
+        # instead would rewrite pages from all over the postings every time
+        with connection:
+            row = connection.execute("SELECT value FROM settings WHERE name = 'settings'").fetchone()
+            if not incremental or row is None or row[0] != settings:
+                if incremental and row is not None and verbose:
+                    print("Question settings have changed, reindexing everything in {}".format(root))
+                for table in ["postings", "questions", "papers"]:
+                    connection.execute("DELETE FROM {}".format(table))
+                connection.execute("INSERT OR REPLACE INTO settings VALUES ('settings', ?)", (settings,))
+            indexed = dict(connection.execute("SELECT paper, fingerprint FROM papers"))
+
+            changed = [txt_file for txt_file in txt_files
+                       if indexed.get(get_filename(txt_file)) != fingerprints[get_filename(txt_file)]]
+            removed = [paper for paper in indexed if paper not in fingerprints]
+            if not changed and not removed:
+                if verbose:
+                    print("Nothing has changed in {}".format(root))
+                return
+
+            for i, txt_file in enumerate(changed, 1):
+                if verbose:
+                    print("Indexing the questions in {} ({} out of {})".format(txt_file, i, len(changed)))
+                paper = get_filename(txt_file)
+                questions = split_into_questions(root, txt_file)
+
+                with stage("questions", txt_file, items=len(questions)):
+                    remove_indexed_paper(connection, paper)
+                    for position, (label, text) in enumerate(questions):
+                        question = connection.execute(
+                            "INSERT INTO questions (paper, position, label, text) VALUES (?, ?, ?, ?)",
+                            (paper, position, label, text)).lastrowid
+                        frequencies = count_ngrams(normalise_text(text).split(" "), stopwords, mode=count_mode)
+                        connection.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                               [(term, question, count) for term, count in frequencies.items()])
+                    connection.execute("INSERT INTO papers VALUES (?, ?)", (paper, fingerprints[paper]))
+
+            for paper in removed:
+                if verbose:
+                    print("Removing {} from the question index, since its txt file is gone".format(paper))
+                remove_indexed_paper(connection, paper)
+    finally:
+        connection.close()
+
+
+def lookup_term(root: str, term: str) -> list:
+    """
+    Find every question in the index of root that has term in it, see index_questions()
+    :param root:
+    :param term: a word or an n-gram of up to 3 words. It's normalised the same way as the text it was counted from
+    :return: list of (paper, question label, frequency), most frequent first
+    """
+    connection = open_question_index(root)
+    try:
+        return connection.execute(
+            "SELECT questions.paper, questions.label, postings.count FROM postings "
+            "JOIN questions ON questions.id = postings.question WHERE postings.term = ? "
+            "ORDER BY postings.count DESC, questions.paper, questions.position",
+            (normalise_text(term).strip(),)).fetchall()
+    finally:
+        connection.close()
+
+
+def score_questions(root: str, topic_index: dict = None) -> dict:
+    """
+    Score every question in the index of root/corpus (see index_questions()) against every topic at once, the same
+    way score_memos() scores whole memos
+    :param root:
+    :param topic_index: see load_topic_index(). Loaded from root if None
+    :return: dict of (paper name : list of (question label, dict of (topic name : score))), with the questions of
+    each paper in order
+    """
+    import numpy as np
+    from scipy import sparse
+    if topic_index is None:
+        topic_index = load_topic_index(root)
+    index = topic_index["index"]
+
+    connection = open_question_index(os.path.join(root, "corpus"))
+    try:
+        questions = connection.execute("SELECT id, paper, label FROM questions ORDER BY paper, position").fetchall()
+        rows = {question: row for row, (question, _, _) in enumerate(questions)}
+        # Terms that aren't in any topic can't add to any score, so they're left out of the question matrix
+        question_rows, indices, data = [], [], []
+        for question, term, count in connection.execute("SELECT question, term, count FROM postings"):
+            if term in index:
+                question_rows.append(rows[question])
+                indices.append(index[term])
+                data.append(count)
+    finally:
+        connection.close()
+
+    matrix = sparse.csr_matrix((np.array(data, dtype=np.int64), (np.array(question_rows, dtype=np.int64),
+                                                                 np.array(indices, dtype=np.int64))),
+                               shape=(len(questions), len(index)))
+
+    scores = (matrix @ topic_index["matrix"].T.astype(np.int64)).toarray()
+    question_scores = {}
+    for (_, paper, label), question_score in zip(questions, scores):
+        question_scores.setdefault(paper, []).append((label, dict(zip(topic_index["topics"], question_score.tolist()))))
+    return question_scores
+
+
+def rank_questions(question_scores: dict, topic: str) -> list:
+    """
+    Find the questions that touch topic
+    :param question_scores: the output of score_questions()
+    :param topic: the name of a topic
+    :return: list of (paper, question label, score) of every question that scored more than 0 for topic, best first
+    """
+    ranked = [(paper, label, scores[topic]) for paper, questions in question_scores.items()
+              for label, scores in questions if scores.get(topic, 0) > 0]
+    return sorted(ranked, key=lambda question: -question[2])
+
+
+def write_question_scores(root: str, question_scores: dict) -> None:
+    """
+    Save the output of score_questions() to root/corpus/summaries/question_scores.json
+    :param root:
+    :param question_scores:
+    :rtype: None
+    """
+    with atomic_write(os.path.join(root, "corpus", "summaries", "question_scores.json")) as json_file:
+        json.dump(question_scores, json_file, indent=2)
+
+
+def create_test_topics(root, topic_ids, total_unique_words=10, total_words=50, graph=True, count=True):
     """
     Create dummy text files, json files, and bar graphs with a regular and manipulable
     structure so as to make debugging and testing easier
@@ -340,6 +2488,7 @@ def create_test_topics(root, topic_ids, total_unique_words=10, total_words=50, g
     :param total_unique_words:
     :param total_words:
     :param graph:
+    :param count: if False, only create the text files
     :return:
     """
 
@@ -369,30 +2518,30 @@ def create_test_topics(root, topic_ids, total_unique_words=10, total_words=50, g
         with open(os.path.join(topic_txt_directory, topic_id + ".txt"), "w+") as file:
             file.writelines(formatted_words)
 
+    if not count:
+        return
     texts_to_jsons(os.path.join(root, "topics"))
     if graph:
         json_paths = sorted(glob.glob(os.path.join(root, "topics", "summaries", "jsons", "*.json")))
-        for json_path in json_paths:
-            json_to_bar_chart(json_path)
+        render_charts(root, json_paths)
 
 
-def create_test_corpus(root: str, test_id: str, topic_weights=None, total_words=300, graph=True):
+def create_test_corpus(root: str, test_id: str, topic_weights=None, total_words=300, graph=True, count=True):
     json_paths = sorted(glob.glob(os.path.join(root, "topics", "summaries", "jsons", "*.json")))
     words = []
     freqs = []
 
     # If no topic_weights were given, set all topic_weights to 1
+    if topic_weights is None:
+        topic_weights = [1] * len(json_paths)
     if len(topic_weights) != len(json_paths):
         raise ValueError(
             "len(topic_weights) doesn't equal len(json_paths) ({}!={})".format(len(topic_weights), len(json_paths)))
-    if topic_weights is None:
-        topic_weights = [1] * len(json_paths)
 
     for i, json_path in enumerate(json_paths):
-        with open(json_path, "r") as jsonfile:
-            data: dict = json.load(jsonfile)
-            words.extend(list(data.keys()))
-            freqs.extend([value * topic_weights[i] for value in data.values()])
+        data: dict = load_frequencies(json_path)
+        words.extend(list(data.keys()))
+        freqs.extend([value * topic_weights[i] for value in data.values()])
 
     corpus_txt_directory = os.path.join(root, "corpus", "txts")
 
@@ -410,12 +2559,306 @@ def create_test_corpus(root: str, test_id: str, topic_weights=None, total_words=
     with open(os.path.join(corpus_txt_directory, test_id + ".txt"), "w+") as file:
         file.writelines(formatted_words)
 
+    if not count:
+        return
     texts_to_jsons(os.path.join(root, "corpus"))
     if graph:
         json_paths = sorted(glob.glob(os.path.join(root, "corpus", "summaries", "jsons", "*.json")))
-        for json_path in json_paths:
-            json_to_bar_chart(json_path)
-            json_to_pie_chart(root, json_path)
+        render_charts(root, json_paths, json_paths)
+
+
+def benchmark_count_ngrams(topic_ids=("a", "b", "c", "d", "e"), total_unique_words=500, total_words=5000,
+                           stopwords_path: str = os.path.join("test_files", "stopwords.txt"),
+                           verbose: bool = True) -> dict:
+    """
+    Time fancy_count() against both modes of count_ngrams() on topics made by create_test_topics().
+    The topics are created in a temporary directory, which is deleted afterwards
+    :param topic_ids:
+    :param total_unique_words:
+    :param total_words: the number of words in each topic
+    :param stopwords_path: stopwords file to copy into the temporary root
+    :param verbose: if True, print the timings
+    :return: dict of (method : total seconds) pairs
+    """
+    timings = {"fancy_count": 0.0, "substring": 0.0, "token": 0.0}
+    # texts_to_jsons() looks for stopwords.txt in the first directory of root, so root has to be relative
+    with tempfile.TemporaryDirectory(dir=".") as tmp_dir:
+        root = os.path.relpath(tmp_dir)
+        shutil.copy(stopwords_path, os.path.join(root, "stopwords.txt"))
+        with open(stopwords_path, "r") as stopwords_txt:
+            stopwords = set([word.strip() for word in stopwords_txt.readlines()])
+        create_directory_structure(root)
+        # Only the txt files are timed, so they aren't counted or charted here
+        create_test_topics(root, topic_ids, total_unique_words=total_unique_words, total_words=total_words,
+                           graph=False, count=False)
+
+        for txt_file in sorted(glob.glob(os.path.join(root, "topics", "txts", "*.txt"))):
+            with open(txt_file, "r") as txt:
+                text = normalise_text("\n".join(txt.readlines()))
+            split_text = text.split(" ")
+
+            for mode in COUNT_MODES:
+                start = time.perf_counter()
+                frequencies = count_ngrams(split_text, stopwords, mode=mode)
+                timings[mode] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected = {token: fancy_count(token, text) for token in frequencies}
+            timings["fancy_count"] += time.perf_counter() - start
+            if expected != count_ngrams(split_text, stopwords, mode="substring"):
+                raise AssertionError("count_ngrams() disagrees with fancy_count() on " + txt_file)
+
+    if verbose:
+        for method, seconds in timings.items():
+            print("{:<12} {:.3f}s".format(method, seconds))
+    return timings
+
+
+def corrupt_word(word: str) -> str:
+    """
+    Make one OCR-like mistake in word: a commonly confused character, or a dropped, doubled or swapped character
+    :param word:
+    :return:
+    """
+    confusions = {"l": "1", "1": "l", "o": "0", "0": "o", "i": "l", "e": "c", "c": "e", "m": "rn", "rn": "m",
+                  "s": "5", "5": "s", "b": "h", "h": "b", "g": "q", "u": "v", "n": "h"}
+    i = random.randrange(len(word))
+    mistake = random.choice(["confuse", "drop", "double", "swap"])
+    if mistake == "confuse" and word[i] in confusions:
+        return word[:i] + confusions[word[i]] + word[i + 1:]
+    if mistake == "drop" and len(word) > 1:
+        return word[:i] + word[i + 1:]
+    if mistake == "swap" and i + 1 < len(word):
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return word[:i] + word[i] + word[i:]
+
+
+def create_word_list(num_words: int, seed: int = 0) -> list:
+    """
+    Make up distinct words that look like the words of a course: 1 to 4 WORD_SYLLABLES long, so they have the
+    lengths of real words, and share syllables the way real words do, which is what makes fuzzy matching ambiguous.
+    The words of create_test_topics() are all 4 characters or less, so they're too short to be fuzzy matched
+    :param num_words: how many words to make
+    :param seed: the same seed always gives the same words
+    :return:
+    """
+    rng = random.Random(seed)
+    words = {}
+    while len(words) < num_words:
+        words["".join(rng.choice(WORD_SYLLABLES) for _ in range(rng.choice([1, 2, 2, 3, 3, 3, 4])))] = None
+    return list(words)
+
+
+def benchmark_fuzzy_matching(root: str = None, total_words: int = 50000, total_unique_words: int = 2000,
+                             corruption_rate: float = 0.1, max_distance: int = 1, min_length: int = FUZZY_MIN_LENGTH,
+                             verbose: bool = True) -> dict:
+    """
+    Corrupt a fraction of the words in a text with corrupt_word(), then time how fast and how accurately
+    fuzzy_lookup() maps them back to the original vocabulary
+    :param root: if not None, the words are taken from root/topics/txts and root/corpus/txts, eg of a course that has
+    been OCR'd. Otherwise they're made up by create_word_list()
+    :param total_words: if root is None, how many words are in the text
+    :param total_unique_words: if root is None, how many different words are in the text. They're used with a Zipf
+    distribution, like the words of real text
+    :param corruption_rate: the fraction of words to corrupt
+    :param max_distance: see build_fuzzy_index()
+    :param min_length: see build_fuzzy_index()
+    :param verbose: if True, print the results
+    :return: dict with "min_length", "index_seconds", "lookup_seconds", "words_per_second", "accuracy" (the fraction
+    of corrupted words mapped back to the original) and "false_matches" (the fraction of corrupted words mapped to
+    another word)
+    """
+    if root is None:
+        unique_words = create_word_list(total_unique_words)
+        words = random.choices(unique_words, weights=[1 / rank for rank in range(1, len(unique_words) + 1)],
+                               k=total_words)
+    else:
+        words = []
+        for txt_file in sorted(glob.glob(os.path.join(root, "*", "txts", "*.txt"))):
+            with open(txt_file, "r") as txt:
+                words.extend(normalise_text(txt.read()).split())
+    vocabulary = {}
+    for word in words:
+        vocabulary[word] = vocabulary.get(word, 0) + 1
+
+    start = time.perf_counter()
+    fuzzy_index = build_fuzzy_index(vocabulary, max_distance=max_distance, min_length=min_length)
+    index_seconds = time.perf_counter() - start
+
+    corrupted = [(word, corrupt_word(word)) for word in words if random.random() < corruption_rate]
+    # Only words that are long enough to be fuzzy matched, and that actually changed into a non-word, are counted
+    corrupted = [(word, mangled) for word, mangled in corrupted
+                 if len(word) >= min_length and mangled not in vocabulary]
+    if not corrupted:
+        raise ValueError("None of the {} words in {} could be corrupted into a non-word of at least {} characters, so "
+                         "there is nothing to measure".format(len(words), root or "the text", min_length))
+
+    start = time.perf_counter()
+    for word in words:
+        fuzzy_lookup(fuzzy_index, word)
+    matches = [fuzzy_lookup(fuzzy_index, mangled) for _, mangled in corrupted]
+    lookup_seconds = time.perf_counter() - start
+
+    correct = sum(match == word for (word, _), match in zip(corrupted, matches))
+    wrong = sum(match is not None and match != word for (word, _), match in zip(corrupted, matches))
+    results = {
+        "min_length": min_length,
+        "index_seconds": index_seconds,
+        "lookup_seconds": lookup_seconds,
+        "words_per_second": (len(words) + len(corrupted)) / max(lookup_seconds, 1e-9),
+        "accuracy": correct / len(corrupted),
+        "false_matches": wrong / len(corrupted),
+    }
+    if verbose:
+        print("{} words, {} corrupted".format(len(words), len(corrupted)))
+        for key, value in results.items():
+            print(("{:<18} {:.3f}" if isinstance(value, float) else "{:<18} {}").format(key, value))
+    return results
+
+
+def git_commit() -> tuple:
+    """
+    :return: (commit hash, whether there are uncommitted changes) of the code being run, or (None, None) if it isn't
+    in a git repository
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status != ""
+
+
+def benchmark_pipeline(total_words: int = 10000, num_topics: int = 5, num_memos: int = 5, memo_words: int = None,
+                       total_unique_words: int = None, count_mode: str = "substring", dpi: int = CHART_DPI,
+                       workers: int = 1, seed: int = 0,
+                       stopwords_path: str = os.path.join("test_files", "stopwords.txt"),
+                       results_path: str = BENCHMARK_RESULTS_PATH, verbose: bool = True) -> dict:
+    """
+    Time each stage of the pipeline after OCR on a synthetic course made by create_test_topics() and
+    create_test_corpus(), in a temporary directory which is deleted afterwards. The generators write txt files
+    directly, so OCR never runs. The result is appended to results_path, so runs on different commits can be compared
+    with compare_benchmarks()
+    :param total_words: the number of words in all the topics together
+    :param num_topics:
+    :param num_memos:
+    :param memo_words: the number of words in all the memos together. Defaults to a tenth of total_words
+    :param total_unique_words: the vocabulary of each topic. Defaults to a twentieth of the words in each topic
+    :param count_mode: see count_ngrams()
+    :param dpi: resolution of the charts
+    :param workers: render the charts in this many processes
+    :param seed: for the random words, so every run of the same size gets the same course
+    :param stopwords_path: stopwords file to copy into the temporary root
+    :param results_path: the JSON lines file to append the result to, or None to not save it
+    :param verbose: if True, print the timings
+    :return: dict with the "parameters", the "seconds" each step took, the "peak_rss_bytes", the "commit" and
+    whether it was "dirty", and the "date"
+    """
+    parameters = {
+        "total_words": total_words,
+        "num_topics": num_topics,
+        "num_memos": num_memos,
+        "memo_words": total_words // 10 if memo_words is None else memo_words,
+        "total_unique_words": total_unique_words or max(10, total_words // num_topics // 20),
+        "count_mode": count_mode,
+        "dpi": dpi,
+        "workers": workers,
+        "seed": seed,
+    }
+    random.seed(seed)
+    seconds = {}
+    # The stages are timed through the report, so put back whatever report was running before
+    previous_report = os.environ.get(REPORT_ENVIRONMENT_VARIABLE)
+    # texts_to_jsons() looks for stopwords.txt in the first directory of root, so root has to be relative
+    with tempfile.TemporaryDirectory(dir=".") as tmp_dir:
+        root = os.path.relpath(tmp_dir)
+        shutil.copy(stopwords_path, os.path.join(root, "stopwords.txt"))
+        create_directory_structure(root)
+        topic_ids = ["t{:0{}}".format(i, len(str(num_topics))) for i in range(num_topics)]
+        create_test_topics(root, topic_ids, total_unique_words=parameters["total_unique_words"],
+                           total_words=total_words // num_topics, graph=False, count=False)
+
+        report_path = os.path.join(root, "report.jsonl")
+        start_report(report_path)
+        try:
+            start = time.perf_counter()
+            texts_to_jsons(os.path.join(root, "topics"), verbose=False, count_mode=count_mode)
+            seconds["topics_texts_to_jsons"] = time.perf_counter() - start
+
+            # The memos are made from the topics' json files, so they can only be created now
+            for i in range(num_memos):
+                create_test_corpus(root, "memo{}".format(i), topic_weights=random.choices(range(1, 5), k=num_topics),
+                                   total_words=parameters["memo_words"] // num_memos, graph=False, count=False)
+            start = time.perf_counter()
+            texts_to_jsons(os.path.join(root, "corpus"), verbose=False, count_mode=count_mode)
+            seconds["corpus_texts_to_jsons"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            chart_memos(root, dpi=dpi, workers=workers, verbose=False)
+            seconds["chart_memos"] = time.perf_counter() - start
+        finally:
+            stop_report()
+            if previous_report is not None:
+                os.environ[REPORT_ENVIRONMENT_VARIABLE] = previous_report
+
+        peak_rss_bytes = None
+        for name, totals in summarise_report(report_path).items():
+            seconds[name] = totals["wall_seconds"]
+            if totals["process_peak_rss_bytes"] is not None:
+                peak_rss_bytes = max(peak_rss_bytes or 0, totals["process_peak_rss_bytes"])
+
+    commit, dirty = git_commit()
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "parameters": parameters,
+        "seconds": seconds,
+        "peak_rss_bytes": peak_rss_bytes,
+    }
+    if results_path is not None:
+        with open(results_path, "a") as results_file:
+            results_file.write(json.dumps(result) + "\n")
+    if verbose:
+        print("{} words, {} topics, {} memos".format(total_words, num_topics, num_memos))
+        for name, value in seconds.items():
+            print("\t{:<24} {:.3f}s".format(name, value))
+    return result
+
+
+def compare_benchmarks(results_path: str = BENCHMARK_RESULTS_PATH,
+                       stages=("topics_texts_to_jsons", "count", "penalties", "score", "render")) -> list:
+    """
+    Print the results saved by benchmark_pipeline() as a table, grouped by the size of the course, so the same
+    size can be compared across commits. Each commit's latest result is used
+    :param results_path:
+    :param stages: which of the "seconds" to show
+    :return: the rows of the table, as (parameters, commit, seconds) tuples
+    """
+    latest = {}
+    with open(results_path, "r") as results_file:
+        for line in results_file:
+            result = json.loads(line)
+            commit = "{}{}".format(result["commit"], "+" if result["dirty"] else "")
+            latest[json.dumps(result["parameters"], sort_keys=True), commit] = result
+
+    rows = sorted(latest.items(), key=lambda item: (item[1]["parameters"]["num_topics"],
+                                                     item[1]["parameters"]["total_words"], item[1]["date"]))
+    widths = [max(12, len(stage_name) + 2) for stage_name in stages]
+    print("{:>10}{:>8}  {:<12}".format("words", "topics", "commit") +
+          "".join("{:>{}}".format(stage_name, width) for stage_name, width in zip(stages, widths)))
+    table = []
+    for (_, commit), result in rows:
+        parameters = result["parameters"]
+        print("{:>10}{:>8}  {:<12}".format(parameters["total_words"], parameters["num_topics"], commit) +
+              "".join("{:>{}.3f}".format(result["seconds"].get(stage_name, float("nan")), width)
+                      for stage_name, width in zip(stages, widths)))
+        table.append((parameters, commit, result["seconds"]))
+    return table
 
 
 def create_directory_structure(root: str):
@@ -433,7 +2876,143 @@ def create_directory_structure(root: str):
                 os.makedirs(os.path.join(root, l1, l2), exist_ok=True)
 
 
-def developement_main() -> None:
+def chart_memos(root: str, num_words: int = 50, dpi: int = CHART_DPI, workers: int = 1, verbose: bool = True,
+                fuzzy_distance: int = 0) -> None:
+    """
+    Score every memo in root/corpus against the topics in root/topics, and graph them.
+    The scores are saved to root/corpus/summaries/topic_scores.json, and the graphs to root/corpus/summaries/bars/
+    and root/corpus/summaries/pies/
+    :param root:
+    :param num_words: the maximum number of words in each bar chart
+    :param dpi: resolution of the saved charts
+    :param workers: if more than 1, render the charts in this many worker processes
+    :param verbose: if True, log progress to the console
+    :param fuzzy_distance: see score_memos()
+    :rtype: None
+    """
+    # Initialise the pretty graph maker
+    set_chart_theme()
+    memo_json_paths = sorted(glob.glob(os.path.join(root, "corpus", "summaries", "jsons", "*.json")))
+    with stage("score", root, items=len(memo_json_paths)):
+        topic_scores = score_memos(root, memo_json_paths, fuzzy_distance=fuzzy_distance)
+    write_topic_scores(root, topic_scores)
+    render_charts(root, memo_json_paths, memo_json_paths, num_words=num_words, dpi=dpi, workers=workers,
+                  verbose=verbose, topic_scores=topic_scores)
+
+
+def run_pipeline(root: str, workers: int = 2, queue_size: int = None, ocr=tesseract_ocr, timeout: float = 0,
+                 cache_dir: str = OCR_CACHE_DIR, count_mode: str = "substring", num_words: int = 50,
+                 dpi: int = CHART_DPI, verbose: bool = True, resume: bool = False, fuzzy_distance: int = 0) -> None:
+    """
+    Does the same as main(), but overlaps the stages instead of running them one after the other:
+    a background thread OCRs the corpus and then the topics, rasterizing pages while the workers OCR the ones before
+    them (see ocr_pages_pipelined()). Meanwhile this thread counts each txt file as soon as the last page of its pdf
+    is done, and a separate process draws each chart as soon as its json is ready. So each memo is counted while the
+    other memos are still being OCR'd, the bar charts are drawn while the topics are, and only the penalties, pie
+    charts and question scores are left once OCR is done.
+    Each hand-over is through a bounded queue, so a fast stage waits for a slow one instead of piling up work.
+    If any stage fails, the others are cancelled and the error is raised
+    :param root:
+    :param workers: the number of OCR worker processes
+    :param queue_size: how many rasterized pages can wait for an OCR worker
+    :param ocr: see tesseract_ocr(). Has to be defined at module level of an importable module, see
+    ocr_pages_pipelined()
+    :param timeout: per-page OCR timeout in seconds, 0 means no timeout
+    :param cache_dir: the OCR cache, or None to not use a cache
+    :param count_mode: see count_ngrams()
+    :param num_words: the maximum number of words in each bar chart
+    :param dpi: resolution of the saved charts
+    :param verbose: if True, log progress to the console
+    :param resume: see main()
+    :param fuzzy_distance: see score_memos()
+    :rtype: None
+    """
+    create_directory_structure(root)
+    cancel = threading.Event()
+    errors = []
+    # The txt files that are ready to be counted, with None after the last one of each part
+    texts_ready = queue.Queue(maxsize=queue_size or 2 * workers)
+
+    def ocr_parts() -> None:
+        try:
+            for part in ["corpus", "topics"]:
+                pdfs_to_texts(os.path.join(root, part), verbose=verbose, workers=workers, ocr=ocr, timeout=timeout,
+                              cache_dir=cache_dir, pipeline=True, queue_size=queue_size, cancel=cancel,
+                              resume=resume,
+                              on_text=lambda text_file_path: put_until_cancelled(texts_ready, text_file_path, cancel))
+                if not put_until_cancelled(texts_ready, None, cancel):
+                    return
+        except CancelledError:
+            pass
+        except BaseException as error:
+            errors.append(error)
+            cancel.set()
+
+    def ready_texts():
+        # The txt files of one part, as the OCR thread writes them
+        while True:
+            try:
+                text_file_path = texts_ready.get(timeout=0.1)
+            except queue.Empty:
+                if cancel.is_set():
+                    raise CancelledError("The pipeline was cancelled")
+                continue
+            if text_file_path is None:
+                return
+            yield text_file_path
+
+    ocr_thread = threading.Thread(target=ocr_parts, daemon=True)
+    ocr_thread.start()
+    charts = []
+    # One process, so drawing charts doesn't take the OCR workers' CPUs
+    # The OCR thread is running while the chart process is started
+    with ProcessPoolExecutor(max_workers=1, mp_context=thread_safe_pool_context(),
+                             initializer=set_chart_theme) as chart_executor:
+        try:
+            for part in ["corpus", "topics"]:
+                try:
+                    texts_to_jsons(os.path.join(root, part), verbose=verbose, count_mode=count_mode,
+                                   incremental=resume, ready=ready_texts())
+                except CancelledError:
+                    break
+
+                memo_json_paths = sorted(glob.glob(os.path.join(root, "corpus", "summaries", "jsons", "*.json")))
+                if part == "corpus":
+                    charts += [chart_executor.submit(render_chart, (json_to_bar_chart,
+                                                                    (json_path, num_words, verbose, dpi), {}))
+                               for json_path in memo_json_paths]
+                else:
+                    with stage("score", root, items=len(memo_json_paths)):
+                        topic_index = load_topic_index(root)
+                        topic_scores = score_memos(root, memo_json_paths, topic_index=topic_index,
+                                                   fuzzy_distance=fuzzy_distance)
+                    write_topic_scores(root, topic_scores)
+                    for json_path in memo_json_paths:
+                        memo_scores = {get_filename(json_path): topic_scores[get_filename(json_path)]}
+                        charts.append(chart_executor.submit(render_chart, (json_to_pie_chart, (
+                            root, json_path, verbose, memo_scores, dpi), {})))
+                    # While the pie charts are drawn, split the memos into questions and score them too
+                    index_questions(os.path.join(root, "corpus"), verbose=verbose, count_mode=count_mode,
+                                    incremental=resume)
+                    write_question_scores(root, score_questions(root, topic_index=topic_index))
+            for chart in charts:
+                if cancel.is_set():
+                    break
+                chart.result()
+        except BaseException:
+            cancel.set()
+            raise
+        finally:
+            if cancel.is_set():
+                for chart in charts:
+                    chart.cancel()
+            ocr_thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def developement_main(root: str = "CSC1015F") -> None:
     """
     Used for running and testing developement builds.
     This function may not be stable, and may corrupt the data.
@@ -441,9 +3020,9 @@ def developement_main() -> None:
     Do not call developement_main() unless you know what you're doing
     :rtype: None
     """
+    import seaborn as sns
 
     sns.set()
-    root = "CSC1015F"
     create_directory_structure(root)
     # create_test_topics(root,
     #                    ["a", "b", "c", "d", "e"],
@@ -456,40 +3035,213 @@ def developement_main() -> None:
     texts_to_jsons(os.path.join(root, "topics"))
 
     json_paths = sorted(glob.glob(os.path.join(root, "topics", "summaries", "penalties", "*.json")))
-    for json_path in json_paths:
-        json_to_bar_chart(json_path, num_words=100)
+    render_charts(root, json_paths, num_words=100)
     # json_to_pie_chart(root, json_path)
     print("developement_main() finished.")
 
 
-def main() -> None:
+def main(root: str = "test_files", resume: bool = False, fuzzy_distance: int = 0, verbose: bool = True) -> None:
     # TODO add more error messages for when files don't exists / for when the program fails
     """
     For first time users. Follow the instructions in the README.md and then run this function.
     This will analyse the pdfs in corpus/pdfs and then produce graphs about the data
+    :param root:
+    :param resume: if True, carry on from where the last run was stopped: pdfs are OCR'd from the page they got up
+    to, and only the txt files that changed since they were last counted are recounted
+    :param fuzzy_distance: if more than 0, match memo words that were mangled by OCR to topic words up to this edit
+    distance away when scoring the memos, see score_memos()
+    :param verbose: if True, log progress to the console
     :rtype: None
     """
-    # Initialise the pretty graph maker
-    sns.set()
-    root = "test_files"
-
     # Ensure there is a directory structure to work in
     create_directory_structure(root)
 
     # Build json files about the memos
-    pdfs_to_texts(os.path.join(root, "corpus"))
-    texts_to_jsons(os.path.join(root, "corpus"))
+    pdfs_to_texts(os.path.join(root, "corpus"), verbose=verbose, cache_dir=OCR_CACHE_DIR, resume=resume)
+    texts_to_jsons(os.path.join(root, "corpus"), verbose=verbose, incremental=resume)
 
     # Build json files about the topics
-    pdfs_to_texts(os.path.join(root, "topics"))
-    texts_to_jsons(os.path.join(root, "topics"))
+    pdfs_to_texts(os.path.join(root, "topics"), verbose=verbose, cache_dir=OCR_CACHE_DIR, resume=resume)
+    texts_to_jsons(os.path.join(root, "topics"), verbose=verbose, incremental=resume)
 
     # Graph the data, saved to root/corpus/summaries/bars/ and root/corpus/summaries/pies/
-    memo_json_paths = sorted(glob.glob(os.path.join(root, "corpus", "summaries", "*.json")))
-    for memo_json_path in memo_json_paths:
-        json_to_bar_chart(memo_json_path)
-        json_to_pie_chart(memo_json_path)
+    chart_memos(root, verbose=verbose, fuzzy_distance=fuzzy_distance)
+
+    # Split the memos into questions and score each question, saved to root/corpus/summaries/question_scores.json
+    index_questions(os.path.join(root, "corpus"), verbose=verbose, incremental=resume)
+    write_question_scores(root, score_questions(root))
+
+
+def run_stage(args: argparse.Namespace) -> None:
+    """
+    Run the stage of the pipeline chosen on the command line, see cli()
+    :param args: the parsed command line arguments
+    :rtype: None
+    """
+    verbose = not args.quiet
+    if args.stage == "benchmark":
+        if not args.compare:
+            for num_topics in args.topics:
+                for total_words in args.words:
+                    benchmark_pipeline(total_words, num_topics, num_memos=args.memos, count_mode=args.mode,
+                                       dpi=args.dpi, workers=args.workers, results_path=args.results, verbose=verbose)
+        compare_benchmarks(args.results)
+        return
+    if args.stage == "all":
+        if args.pipeline:
+            run_pipeline(args.root, workers=args.workers, queue_size=args.queue_size, verbose=verbose,
+                         resume=args.resume, fuzzy_distance=args.fuzzy_distance)
+        else:
+            main(args.root, resume=args.resume, fuzzy_distance=args.fuzzy_distance, verbose=verbose)
+        return
+    if args.stage == "dev":
+        developement_main(args.root)
+        return
+    if args.stage == "questions":
+        corpus = os.path.join(args.root, "corpus")
+        if not args.term:
+            create_directory_structure(args.root)
+            index_questions(corpus, verbose=verbose, count_mode=args.mode, incremental=args.incremental)
+            question_scores = score_questions(args.root)
+            write_question_scores(args.root, question_scores)
+            if args.topic is not None:
+                for paper, label, score in rank_questions(question_scores, args.topic):
+                    print("{:>8}  {} {}".format(score, paper, label))
+        for term in args.term:
+            print(term)
+            for paper, label, count in lookup_term(corpus, term):
+                print("{:>8}  {} {}".format(count, paper, label))
+        return
+    if args.stage == "charts":
+        chart_memos(args.root, num_words=args.num_words, dpi=args.dpi, workers=args.workers, verbose=verbose,
+                    fuzzy_distance=args.fuzzy_distance)
+        return
+
+    create_directory_structure(args.root)
+    for part in (["corpus", "topics"] if args.part == "both" else [args.part]):
+        path = os.path.join(args.root, part)
+        if args.stage == "ocr":
+            pdfs_to_texts(path, verbose=verbose, reuse=not args.no_reuse, workers=args.workers, timeout=args.timeout,
+                          stream=args.stream, keep_pngs=not args.no_keep_pngs, pages_per_read=args.pages_per_read,
+                          cache_dir=None if args.no_cache else args.cache_dir, cache_max_bytes=args.cache_max_bytes,
+                          cache_max_age_days=args.cache_max_age_days, text_layer=not args.no_text_layer,
+                          resume=args.resume)
+        elif args.stage == "count":
+            texts_to_jsons(path, verbose=verbose, count_mode=args.mode, incremental=args.incremental,
+                           penalty_top_k=args.penalty_top_k, summary_top_k=args.summary_top_k,
+                           compact=args.compact, sidecar=args.sidecar)
+        elif args.stage == "penalties":
+            json_paths = sorted(glob.glob(os.path.join(path, "summaries", "jsons", "*.json")))
+            write_penalties(path, json_paths, verbose=verbose, top_k=args.top_k, compact=args.compact)
+
+
+def cli(args: list = None) -> None:
+    """
+    Command line entry point, with a subcommand for each stage of main() so they can be run on their own.
+    Run `python main.py --help` for the details
+    :param args: the command line arguments, defaults to sys.argv[1:]
+    :rtype: None
+    """
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--quiet", action="store_true", help="don't log progress to the console")
+    options.add_argument("--profile", default=None, help="run cProfile and save the stats to this file")
+    common = argparse.ArgumentParser(add_help=False, parents=[options])
+    common.add_argument("root", help="the course directory, eg CSC1015F")
+    common.add_argument("--report", default=None,
+                        help="record the time and memory of every stage, document and page to this JSON lines file")
+    parts = argparse.ArgumentParser(add_help=False)
+    parts.add_argument("--part", choices=["corpus", "topics", "both"], default="both",
+                       help="whether to process the memos (corpus), the lecture notes (topics) or both")
+
+    parser = argparse.ArgumentParser(description="Find out which topics each exam memo is made of")
+    stages = parser.add_subparsers(dest="stage", required=True)
+
+    ocr = stages.add_parser("ocr", parents=[common, parts], help="extract the text from root/*/pdfs")
+    ocr.add_argument("--workers", type=int, default=1, help="OCR pages in this many processes")
+    ocr.add_argument("--timeout", type=float, default=0, help="per-page OCR timeout in seconds")
+    ocr.add_argument("--stream", action="store_true", help="rasterize one window of pages at a time")
+    ocr.add_argument("--pages-per-read", type=int, default=1, help="pages per window when streaming")
+    ocr.add_argument("--no-keep-pngs", action="store_true", help="don't save page images when streaming")
+    ocr.add_argument("--no-reuse", action="store_true", help="redo files that already exist")
+    ocr.add_argument("--no-text-layer", action="store_true", help="OCR every page, even if it has a text layer")
+    ocr.add_argument("--cache-dir", default=OCR_CACHE_DIR, help="where to cache OCR'd pages")
+    ocr.add_argument("--no-cache", action="store_true", help="don't use the OCR cache")
+    ocr.add_argument("--cache-max-bytes", type=int, default=None, help="evict pages until the cache is this big")
+    ocr.add_argument("--cache-max-age-days", type=float, default=None, help="evict pages unused for this long")
+    ocr.add_argument("--resume", action="store_true", help="carry on from the page each unfinished pdf got up to")
+
+    count = stages.add_parser("count", parents=[common, parts], help="count the words in root/*/txts")
+    count.add_argument("--mode", choices=COUNT_MODES, default="substring", help="see count_ngrams()")
+    count.add_argument("--incremental", action="store_true", help="only recount txt files that changed")
+    count.add_argument("--summary-top-k", type=int, default=None, help="only save this many tokens per json")
+    count.add_argument("--penalty-top-k", type=int, default=None, help="only save this many penalties per topic")
+    count.add_argument("--compact", action="store_true", help="write json without whitespace")
+    count.add_argument("--sidecar", action="store_true", help="save the full vocabulary to binary .vocab files")
+
+    penalties = stages.add_parser("penalties", parents=[common, parts],
+                                  help="recalculate root/*/summaries/penalties from the json files")
+    penalties.add_argument("--top-k", type=int, default=None, help="only save this many penalties per topic")
+    penalties.add_argument("--compact", action="store_true", help="write json without whitespace")
+
+    charts = stages.add_parser("charts", parents=[common], help="score the memos and graph them")
+    charts.add_argument("--num-words", type=int, default=50, help="words per bar chart")
+    charts.add_argument("--dpi", type=int, default=CHART_DPI, help="resolution of the charts")
+    charts.add_argument("--workers", type=int, default=1, help="render charts in this many processes")
+    charts.add_argument("--fuzzy-distance", type=int, default=0,
+                        help="match memo words mangled by OCR to topic words up to this edit distance away")
+
+    questions = stages.add_parser("questions", parents=[common],
+                                  help="split the memos into questions, index them and score them against the topics")
+    questions.add_argument("--mode", choices=COUNT_MODES, default="substring", help="see count_ngrams()")
+    questions.add_argument("--incremental", action="store_true", help="only reindex txt files that changed")
+    questions.add_argument("--topic", default=None, help="then list the questions that touch this topic, best first")
+    questions.add_argument("--term", nargs="+", default=[],
+                           help="don't reindex, just list the questions that have these words or n-grams in them")
+
+    everything = stages.add_parser("all", parents=[common], help="run every stage, like main()")
+    everything.add_argument("--pipeline", action="store_true",
+                            help="overlap the stages instead of running them one after the other, see run_pipeline()")
+    everything.add_argument("--workers", type=int, default=2, help="if --pipeline, OCR pages in this many processes")
+    everything.add_argument("--queue-size", type=int, default=None,
+                            help="if --pipeline, how many rasterized pages can wait for an OCR worker")
+    everything.add_argument("--resume", action="store_true",
+                            help="carry on from where the last run was stopped, see main()")
+    everything.add_argument("--fuzzy-distance", type=int, default=0,
+                            help="match memo words mangled by OCR to topic words up to this edit distance away")
+    stages.add_parser("dev", parents=[common], help="run developement_main()")
+
+    benchmark = stages.add_parser("benchmark", parents=[options],
+                                  help="time every stage after OCR on synthetic courses, see benchmark_pipeline()")
+    benchmark.add_argument("--words", type=int, nargs="+", default=[10000, 100000, 1000000],
+                           help="total words in the topics of each course")
+    benchmark.add_argument("--topics", type=int, nargs="+", default=[5, 50], help="topics in each course")
+    benchmark.add_argument("--memos", type=int, default=5, help="memos in each course")
+    benchmark.add_argument("--mode", choices=COUNT_MODES, default="substring", help="see count_ngrams()")
+    benchmark.add_argument("--dpi", type=int, default=CHART_DPI, help="resolution of the charts")
+    benchmark.add_argument("--workers", type=int, default=1, help="render charts in this many processes")
+    benchmark.add_argument("--results", default=BENCHMARK_RESULTS_PATH, help="where to save the results")
+    benchmark.add_argument("--compare", action="store_true", help="just print the results saved so far")
+    benchmark.set_defaults(report=None)
+
+    args = parser.parse_args(args)
+    if args.report is not None:
+        start_report(args.report)
+    try:
+        with profiled(args.profile):
+            run_stage(args)
+    finally:
+        if args.report is not None:
+            stop_report()
+    if args.report is not None:
+        print("{:<12}{:>8}{:>12}{:>12}{:>12}{:>12}  {}".format("stage", "records", "wall (s)", "cpu (s)",
+                                                             "peak +MB", "max RSS MB", "slowest"))
+        for name, totals in summarise_report(args.report).items():
+            growth, rss = totals["peak_growth_bytes"], totals["max_rss_bytes"]
+            print("{:<12}{:>8}{:>12.2f}{:>12.2f}{:>12}{:>12}  {} ({:.2f}s)".format(
+                name, totals["records"], totals["wall_seconds"], totals["cpu_seconds"],
+                "-" if growth is None else "{:.0f}".format(growth / 2 ** 20),
+                "-" if rss is None else "{:.0f}".format(rss / 2 ** 20), *totals["slowest"]))
 
 
 if __name__ == '__main__':
-    developement_main()
+    cli()
@@ -0,0 +1,273 @@
+import filecmp
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+import main
+
+# Modules that main.py should only import in the functions that need them, see test_import_is_light()
+HEAVY_MODULES = ["numpy", "scipy", "matplotlib", "seaborn", "nltk", "wand", "pytesseract", "PIL", "pypdf"]
+
+# Seconds that `import main` can take in a fresh interpreter
+IMPORT_TIME_BUDGET = 0.5
+
+TOPICS = {
+    "a": "recursion base case recursive call recursion stack",
+    "b": "sorting quicksort pivot partition sorting merge sort",
+    "c": "linked list node pointer list head node",
+}
+
+
+def write_topics(root: str, topics: dict) -> None:
+    # load_stopwords() looks in the first directory of root
+    with open(os.path.join(root.split(os.sep)[0], "stopwords.txt"), "w") as stopwords_txt:
+        stopwords_txt.write("the\na\n")
+    for name, text in topics.items():
+        with open(os.path.join(root, "txts", name + ".txt"), "w") as txt_file:
+            txt_file.write(text)
+
+
+def stub_ocr(image, timeout=0):
+    # At module level so worker processes can unpickle it. Each test page is a solid grey level, which stands for its
+    # page number. Earlier pages take longer, so they finish out of order, and level 0 never finishes in time
+    level = image.getpixel((0, 0))
+    if level == 0:
+        raise TimeoutError("page 0")
+    time.sleep(0.05 / level)
+    return "page {}\n".format(level)
+
+
+def axes_facecolor() -> str:
+    import matplotlib
+    return matplotlib.rcParams["axes.facecolor"]
+
+
+def write_pages(directory, name: str, levels: list) -> list:
+    from PIL import Image as PILImage
+    paths = []
+    for page_number, level in enumerate(levels):
+        paths.append(str(directory / "{}-{}.png".format(name, page_number)))
+        PILImage.new("L", (8, 8), level).save(paths[-1])
+    return paths
+
+
+def summary_files(root: str) -> list:
+    summaries = os.path.join(root, "summaries")
+    return sorted(os.path.relpath(os.path.join(directory, name), summaries)
+                  for directory, _, names in os.walk(summaries) for name in names)
+
+
+@pytest.mark.parametrize("settings", [
+    {},
+    {"summary_top_k": 3, "compact": True},
+    {"count_mode": "token", "penalty_top_k": 4},
+    {"sidecar": True},
+])
+def test_incremental_counts_match_a_full_rebuild(tmp_path, monkeypatch, settings):
+    # load_stopwords() looks in the first directory of root, so the roots have to be relative
+    monkeypatch.chdir(tmp_path)
+    main.create_directory_structure("course")
+    incremental = os.path.join("course", "topics")
+    write_topics(incremental, TOPICS)
+    main.texts_to_jsons(incremental, verbose=False, incremental=True, **settings)
+
+    # Add a topic, edit one and delete another
+    changed = dict(TOPICS, d="hash table bucket collision hash function")
+    changed["a"] = "recursion tail call recursion memoisation"
+    del changed["c"]
+    os.remove(os.path.join(incremental, "txts", "c.txt"))
+    write_topics(incremental, changed)
+    main.texts_to_jsons(incremental, verbose=False, incremental=True, **settings)
+
+    main.create_directory_structure("rebuilt")
+    rebuilt = os.path.join("rebuilt", "topics")
+    write_topics(rebuilt, changed)
+    main.texts_to_jsons(rebuilt, verbose=False, **settings)
+
+    files = summary_files(rebuilt)
+    assert files == summary_files(incremental)
+    assert "jsons/c.json" not in files
+    _, mismatch, errors = filecmp.cmpfiles(os.path.join(rebuilt, "summaries"), os.path.join(incremental, "summaries"),
+                                           files, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+# Texts whose separators land on every side of the chunk boundaries in test_tokenize_file_matches_split()
+TOKENIZE_TEXTS = [
+    "",
+    "word",
+    "Recursion, base case.\nRecursive call: stack",
+    "  leading and trailing whitespace  \n",
+    ".,;leading and trailing punctuation.,;",
+    "runs  ..,,  of\n\n\t separators ;;;; @@ || across \"chunks\"",
+    " ",
+    "a b c",
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 65536])
+@pytest.mark.parametrize("text", TOKENIZE_TEXTS)
+def test_tokenize_file_matches_split(tmp_path, text, chunk_size):
+    txt_path = tmp_path / "text.txt"
+    txt_path.write_text(text)
+    assert list(main.tokenize_file(str(txt_path), chunk_size=chunk_size)) == main.normalise_text(text).split(" ")
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_substring_counts_match_fancy_count(seed):
+    # Few letters and short words, so tokens keep turning up inside other words and n-grams overlap
+    rng = random.Random(seed)
+    split_text = ["".join(rng.choice("ab") for _ in range(rng.randint(1, 5))) for _ in range(rng.randint(1, 40))]
+    frequencies = main.count_ngrams(split_text, {"ab", "aa b"}, mode="substring")
+    text = " ".join(split_text)
+    assert frequencies == {token: main.fancy_count(token, text) for token in frequencies}
+    assert set(frequencies) == set(main.count_ngrams(split_text, {"ab", "aa b"}, mode="token"))
+
+
+@pytest.mark.parametrize("incremental", [False, True])
+def test_counting_txt_files_as_they_are_ready(tmp_path, monkeypatch, incremental):
+    monkeypatch.chdir(tmp_path)
+    for root in ["ready", "rebuilt"]:
+        main.create_directory_structure(root)
+        write_topics(os.path.join(root, "topics"), TOPICS)
+        main.texts_to_jsons(os.path.join(root, "topics"), verbose=False)
+    changed = dict(TOPICS, a="recursion tail call recursion memoisation", d="hash table bucket collision")
+
+    topics = os.path.join("ready", "topics")
+    write_topics(topics, {"a": "recursion draft words"})
+    ready = [os.path.join(topics, "txts", "a.txt"), os.path.join(topics, "txts", "b.txt")]
+
+    def written_while_counting():
+        # A txt file can be written again after it's handed over, and some are only found once ready runs out
+        yield ready[0]
+        yield ready[1]
+        write_topics(topics, changed)
+        yield ready[0]
+
+    main.texts_to_jsons(topics, verbose=False, incremental=incremental, ready=written_while_counting())
+    rebuilt = os.path.join("rebuilt", "topics")
+    write_topics(rebuilt, changed)
+    main.texts_to_jsons(rebuilt, verbose=False)
+
+    files = summary_files(rebuilt)
+    assert files == summary_files(topics)
+    _, mismatch, errors = filecmp.cmpfiles(os.path.join(rebuilt, "summaries"), os.path.join(topics, "summaries"),
+                                           files, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+def test_main_runs_without_pdfs(tmp_path, monkeypatch, capsys):
+    # A fresh checkout: no pdfs, and no OCR cache yet
+    monkeypatch.chdir(tmp_path)
+    main.create_directory_structure("course")
+    write_topics(os.path.join("course", "topics"), {})
+    main.main("course", verbose=False)
+    assert capsys.readouterr().out == ""
+    assert os.path.exists(os.path.join(main.OCR_CACHE_DIR, "manifest.json"))
+    with open(os.path.join("course", "corpus", "summaries", "question_scores.json")) as json_file:
+        assert json.load(json_file) == {}
+
+
+@pytest.mark.parametrize("verbose", [True, False])
+def test_ocr_pages_in_parallel_keeps_page_order(tmp_path, capsys, verbose):
+    pages = write_pages(tmp_path, "memo", [1, 2, 0, 3, 4, 5])
+    texts = main.ocr_pages_in_parallel(pages, 3, verbose=verbose, ocr=stub_ocr, timeout=1)
+    assert texts == [(None, "page 1\n"), (None, "page 2\n"), (None, ""), (None, "page 3\n"), (None, "page 4\n"),
+                     (None, "page 5\n")]
+    assert capsys.readouterr().out.count("Extracted text from") == (len(pages) if verbose else 0)
+
+
+def test_pdfs_to_texts_with_workers(tmp_path, monkeypatch, capsys):
+    main.create_directory_structure(str(tmp_path))
+    root = str(tmp_path / "corpus")
+    pdf_pages = {"first": [3, 1, 2], "second": [0, 4]}
+    for name, levels in pdf_pages.items():
+        (tmp_path / "corpus" / "pdfs" / (name + ".pdf")).write_bytes(name.encode())
+        pdf_pages[name] = write_pages(tmp_path, name, levels)
+    monkeypatch.setattr(main, "rasterize_pdf", lambda root, pdf_path, verbose=True, reuse=True:
+                        pdf_pages[main.get_filename(pdf_path)])
+
+    main.pdfs_to_texts(root, verbose=False, workers=2, ocr=stub_ocr, timeout=1, text_layer=False)
+    assert capsys.readouterr().out == ""
+    assert (tmp_path / "corpus" / "txts" / "first.txt").read_text() == "page 3\npage 1\npage 2\n"
+    assert (tmp_path / "corpus" / "txts" / "second.txt").read_text() == "page 4\n"
+
+
+def test_chart_workers_use_the_theme():
+    import seaborn as sns
+    with sns.axes_style("darkgrid"):
+        themed = axes_facecolor()
+    with ProcessPoolExecutor(max_workers=1, mp_context=main.thread_safe_pool_context(),
+                             initializer=main.set_chart_theme) as executor:
+        assert executor.submit(axes_facecolor).result() == themed
+
+
+def test_import_is_light():
+    # A fresh interpreter, so nothing has been imported by other tests
+    script = ("import json, sys, time\n"
+              "start = time.perf_counter()\n"
+              "import main\n"
+              "print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))\n")
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    loaded = [module for module in result["modules"] if module.split(".")[0] in HEAVY_MODULES]
+    assert loaded == []
+    assert result["seconds"] < IMPORT_TIME_BUDGET
+
+
+def test_ocr_settings_dont_depend_on_how_main_was_imported():
+    # Spawned workers import main.py as __mp_main__, and `python main.py` runs it as __main__
+    spec = importlib.util.spec_from_file_location("__mp_main__", main.__file__)
+    worker_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker_main)
+    assert worker_main.ocr_settings(worker_main.tesseract_ocr) == main.ocr_settings(main.tesseract_ocr)
+
+
+def test_stage_records_its_own_memory(tmp_path):
+    report_path = str(tmp_path / "report.jsonl")
+    main.start_report(report_path)
+    try:
+        with main.stage("count", "big.txt"):
+            block = b"x" * (64 << 20)
+        del block
+        with main.stage("count", "small.txt"):
+            pass
+    finally:
+        main.stop_report()
+    with open(report_path) as report_file:
+        big, small = [json.loads(line) for line in report_file]
+    if big["rss_end_bytes"] is None:
+        pytest.skip("current_rss() isn't available on this platform")
+    assert big["rss_end_bytes"] - big["rss_start_bytes"] >= 32 << 20
+    assert abs(small["rss_end_bytes"] - small["rss_start_bytes"]) < 32 << 20
+    assert small["peak_growth_bytes"] == 0
+    summary = main.summarise_report(report_path)["count"]
+    assert summary["records"] == 2
+    assert summary["peak_growth_bytes"] == big["peak_growth_bytes"]
+    assert summary["max_rss_bytes"] == big["rss_end_bytes"]
+
+
+def test_ocr_page_reports_rasterize(tmp_path, monkeypatch):
+    def rasterize_pdf_pages(pdf_path, first_page=0, last_page=None, pages_per_read=1):
+        for page_number in range(first_page, 3 if last_page is None else last_page):
+            yield page_number, object()
+
+    monkeypatch.setattr(main, "rasterize_pdf_pages", rasterize_pdf_pages)
+    report_path = str(tmp_path / "report.jsonl")
+    main.start_report(report_path)
+    try:
+        assert main.ocr_page(("x.pdf", 1, None), ocr=lambda image, timeout=0: "text") == (None, "text")
+    finally:
+        main.stop_report()
+    with open(report_path) as report_file:
+        records = [json.loads(line) for line in report_file]
+    assert sorted((record["stage"], record["document"]) for record in records) == [("ocr", "x.pdf[1]"),
+                                                                                   ("rasterize", "x.pdf[1]")]